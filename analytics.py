@@ -0,0 +1,111 @@
+import datetime
+import numpy as np
+import pandas as pd
+import queries
+import instrument
+import timeseries_store
+
+#
+# Columnar analytics over finalProject.db. Each table is read with one (memoized) query into a
+# pandas frame and every metric is computed on whole columns at once instead of per-state loops.
+#
+
+def load_cases(conn):
+    '''Takes in the connection variable. Reads CovidData joined with States and Dates in one query.
+    Returns a frame with state_id, state, date (YYYYMMDD int) and cases columns.'''
+    return queries.cases_frame(conn.cursor())
+
+def load_population(conn):
+    '''Takes in the connection variable. Reads Population joined with States in one query. Returns a
+    frame with state_id, state, name, year and population columns.'''
+    return queries.population_frame(conn.cursor())
+
+def cases_matrix(cases):
+    '''Takes in a frame from load_cases. Returns the cases as a date by state frame (one column per
+    lowercase state abbreviation, in state_id order), with NaN where a day is missing.'''
+    wide = cases.pivot(index='date', columns='state', values='cases').astype(float)
+    order = cases.drop_duplicates('state').sort_values('state_id')['state']
+    return wide[order]
+
+@instrument.timed('analytics')
+def state_metrics(conn, start_date=20201201, end_date=20210307, year=2020, base_year=2010, cases=None, population=None):
+    '''Takes in the connection variable, the two dates to compare as YYYYMMDD ints, the population year to
+    divide by, the earlier population year to compare it with, and optionally frames already returned by
+    load_cases and load_population. Returns a frame indexed by lowercase state abbreviation (state_id order)
+    with the columns state_id, name, cases_start, cases_end, percent_change, population, base_population,
+    cases_per_capita (cases on start_date over population), population_growth (population over
+    base_population), and percent_change_rank, cases_rank, per_capita_rank (1 is highest). Values that
+    can't be computed are NaN.'''
+    if cases is None:
+        cases = load_cases(conn)
+    if population is None:
+        population = load_population(conn)
+
+    wide = cases_matrix(cases)
+    pops = population.pivot(index='year', columns='state', values='population').astype(float)
+    states = population.drop_duplicates('state').set_index('state')['name']
+    state_ids = pd.concat([cases, population]).drop_duplicates('state').set_index('state')['state_id'].sort_values()
+    index = state_ids.index
+
+    frame = pd.DataFrame(index=index)
+    frame.index.name = 'state'
+    frame['state_id'] = state_ids
+    frame['name'] = states.reindex(index)
+    frame['cases_start'] = wide.loc[start_date].reindex(index) if start_date in wide.index else np.nan
+    frame['cases_end'] = wide.loc[end_date].reindex(index) if end_date in wide.index else np.nan
+    frame['percent_change'] = (frame['cases_end'] - frame['cases_start']) / frame['cases_start'].replace(0, np.nan) * 100
+    frame['population'] = pops.loc[year].reindex(index) if year in pops.index else np.nan
+    frame['base_population'] = pops.loc[base_year].reindex(index) if base_year in pops.index else np.nan
+    frame['cases_per_capita'] = frame['cases_start'] / frame['population']
+    frame['population_growth'] = frame['population'] / frame['base_population']
+
+    frame['percent_change_rank'] = frame['percent_change'].rank(ascending=False, method='min')
+    frame['cases_rank'] = frame['cases_start'].rank(ascending=False, method='min')
+    frame['per_capita_rank'] = frame['cases_per_capita'].rank(ascending=False, method='min')
+    return frame
+
+@instrument.timed('rolling_average')
+def rolling_average(conn, window=7, new_cases=True, cases=None):
+    '''Takes in the connection variable, the window length in days, whether to average daily new cases
+    (the day-over-day difference) rather than the running total, and optionally a frame already returned
+    by load_cases. Returns a date by state frame of the trailing window-day mean; the first window-1 days
+    of each state are NaN.'''
+    if cases is None:
+        cases = load_cases(conn)
+
+    wide = cases_matrix(cases)
+    if new_cases:
+        wide = wide.diff()
+    return wide.rolling(window, min_periods=window).mean()
+
+@instrument.timed('store_rolling_average')
+def store_rolling_average(conn, store, metric='positive', window=7, new_cases=True, start_date=None, end_date=None):
+    '''Takes in the connection variable, a timeseries_store.TimeSeriesStore, the stored metric, the window
+    length in days, whether to average daily new values rather than the running total and optionally a
+    YYYYMMDD date range. Does what rolling_average does with NumPy straight on the memory-mapped series
+    instead of going through CovidData, and returns a frame of the same shape (dates by states in state_id
+    order). Days before start_date are read too so the first days of the range get a full window.'''
+    lead = window if new_cases else window - 1
+    first = None
+    if start_date is not None:
+        first = timeseries_store.to_date(timeseries_store.to_day(start_date) - datetime.timedelta(days=lead))
+    values = store.view(metric, first, end_date)
+    dates = store.dates(metric, first, end_date)
+
+    data = np.where(values == timeseries_store.MISSING, np.nan, values)
+    if new_cases:
+        data = np.vstack([np.full((1, data.shape[1]), np.nan), np.diff(data, axis=0)])
+    #trailing sums from a cumulative sum, NaN wherever a window holds a missing day
+    sums = np.cumsum(np.nan_to_num(data), axis=0)
+    gaps = np.cumsum(np.isnan(data), axis=0)
+    sums[window:] = sums[window:] - sums[:-window]
+    gaps[window:] = gaps[window:] - gaps[:-window]
+    means = sums / window
+    means[gaps > 0] = np.nan
+    means[:window - 1] = np.nan
+
+    states = pd.read_sql_query('SELECT state FROM States ORDER BY state_id', conn)['state'][:data.shape[1]]
+    frame = pd.DataFrame(means, index=pd.Index(dates, name='date'), columns=pd.Index(states, name='state'))
+    if start_date is not None:
+        frame = frame[frame.index >= start_date]
+    return frame
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+#
+# End-to-end benchmark of the pipeline stages against the local mock_server, for synthetic datasets
+# of every area in states.csv x N days. Usage: python benchmarks/bench_pipeline.py [--days 30,365] [--latency 0.02]
+# [--failure-rate 0.01] [--json report.json]
+#
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import mock_server
+import database
+import covid_data
+import population_data
+import analytics
+import queries
+import viz
+import timeseries_store
+
+def timed(func, *args, **kwargs):
+    '''Runs func and returns its result with the wall time in seconds.'''
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def fresh_db(work_dir, name):
+    '''Creates an empty project database in work_dir. Returns cur, conn and its path.'''
+    path = os.path.join(work_dir, name)
+    cur, conn = database.setUpDatabase(path)
+    database.create_tables(cur, conn)
+    covid_data.date_table(cur, conn)
+    return cur, conn, path
+
+def bench_days(days, args, work_dir):
+    '''Runs every stage for one dataset size. Returns a dictionary of stage name to measurements.'''
+    server = mock_server.start_server(days=days, latency=args.latency, failure_rate=args.failure_rate)
+    states = [state for state, name in database.load_states()]
+    fetch = {'base_url': server.base_url, 'max_workers': args.workers, 'backoff': 0.05}
+    results = {}
+    try:
+        cur, conn, path = fresh_db(work_dir, f'sync_{days}.db')
+        rows, seconds = timed(covid_data.sync, cur, conn, states, **fetch)
+        results['ingest_sync'] = {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds}
+        _, seconds = timed(covid_data.sync, cur, conn, states, **fetch)
+        results['ingest_sync_noop'] = {'seconds': seconds}
+
+        stream_cur, stream_conn, _ = fresh_db(work_dir, f'stream_{days}.db')
+        rows, seconds = timed(covid_data.stream_sync, stream_cur, stream_conn, states, **fetch)
+        results['ingest_stream'] = {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds}
+        stream_conn.close()
+
+        write_cur, write_conn, _ = fresh_db(work_dir, f'write_{days}.db')
+        ids = covid_data.date_ids(write_cur, write_conn, [day['date'] for day in mock_server.synthetic_daily('al', 1, days, 20210307, 206)])
+        def write_rows():
+            with database.BatchWriter(write_cur, write_conn, covid_data.COVID_INSERT) as writer:
+                for state_id in range(1, len(states) + 1):
+                    for date_id in ids.values():
+                        writer.add((state_id, date_id, state_id * date_id))
+            return writer.written
+        rows, seconds = timed(write_rows)
+        results['db_write'] = {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds}
+        write_conn.close()
+
+        html, seconds = timed(population_data.get_page, server.pop_url)
+        (pop_2020, pop_2010), parse_seconds = timed(population_data.get_pops, html)
+        _, write_seconds = timed(lambda: population_data.pop_table(cur, conn, pop_2010, 2010) + population_data.pop_table(cur, conn, pop_2020, 2020))
+        results['population'] = {'fetch_seconds': seconds, 'parse_seconds': parse_seconds, 'write_seconds': write_seconds}
+
+        queries.clear_cache()
+        metrics, seconds = timed(analytics.state_metrics, conn)
+        _, rolling_seconds = timed(analytics.rolling_average, conn)
+        _, sql_seconds = timed(covid_data.percent_change, cur, conn, states)
+        results['analytics'] = {'state_metrics_seconds': seconds, 'rolling_average_seconds': rolling_seconds, 'percent_change_sql_seconds': sql_seconds}
+
+        store = timeseries_store.TimeSeriesStore(cur, conn, os.path.join(work_dir, f'timeseries_{days}'))
+        stored_days, load_seconds = timed(store.load_cases)
+        _, view_seconds = timed(lambda: store.view('positive').sum())
+        _, rolling_seconds = timed(analytics.store_rolling_average, conn, store)
+        results['timeseries'] = {'load_seconds': load_seconds, 'days': stored_days, 'scan_seconds': view_seconds, 'rolling_average_seconds': rolling_seconds}
+        store.close()
+        conn.close()
+
+        out_dir = os.path.join(work_dir, f'charts_{days}')
+        cache_file = os.path.join(work_dir, f'render_cache_{days}.db')
+        paths, seconds = timed(viz.render_all, out_dir, ['png'], args.processes, path, cache_file)
+        _, cached_seconds = timed(viz.render_all, out_dir, ['png'], args.processes, path, cache_file)
+        results['render'] = {'seconds': seconds, 'charts': len(paths), 'cached_seconds': cached_seconds}
+
+        results['server'] = dict(server.stats)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ingest, write, analytics and render stages against the mock server.')
+    parser.add_argument('--days', default='30,365', help='comma separated numbers of days per state')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock server latency per request in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests the mock server fails')
+    parser.add_argument('--workers', type=int, default=10, help='concurrent fetches')
+    parser.add_argument('--processes', type=int, help='render processes (default: one per CPU)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='covid_bench_')
+    report = {}
+    try:
+        for days in [int(value) for value in args.days.split(',')]:
+            report[days] = bench_days(days, args, work_dir)
+            print(f"{len(database.load_states())} areas x {days} days")
+            for stage, values in report[days].items():
+                print(f"  {stage:18} " + '  '.join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in values.items()))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
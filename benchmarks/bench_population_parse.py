@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import tracemalloc
+from bs4 import BeautifulSoup
+
+#
+# Compares the old full-page BeautifulSoup parse with population_data.get_pops on a saved copy
+# of the population page. Usage: python benchmarks/bench_population_parse.py [page.html] [repeats]
+#
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import population_data
+
+def full_page_parse(html):
+    '''The parse main() used to do: html.parser tree of the whole page, then one table walk per year.
+    Keeps every row with a population, DC and the territories included, like get_pops.'''
+    soup = BeautifulSoup(html, 'html.parser')
+    pops = []
+    for column in (3, 4):
+        table = soup.find('table', {'class': 'wikitable sortable'})
+        all_rows = table.find('tbody').find_all('tr')
+        pop_dict = {}
+        for row in all_rows[2:]:
+            row_cells = row.find_all('td')
+            if len(row_cells) < 5:
+                continue
+            pop_dict[row_cells[2].text.strip()] = row_cells[column].text.strip()
+        pops.append(pop_dict)
+    return tuple(pops)
+
+def measure(func, html, repeats):
+    '''Returns the best wall time in seconds over repeats runs and the peak traced memory in bytes.'''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(html)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    func(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, 'fixtures', 'population_page.html')
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+
+    if full_page_parse(html) != population_data.get_pops(html):
+        raise SystemExit("parsers disagree")
+
+    print(f"page: {path} ({len(html) / 1024:.0f} KiB), parser: {population_data.HTML_PARSER}")
+    for name, func in (('full page html.parser', full_page_parse), ('targeted get_pops', population_data.get_pops)):
+        best, peak = measure(func, html, repeats)
+        print(f"{name:24} {best * 1000:8.1f} ms  peak {peak / 1024 / 1024:6.2f} MiB")
+
+if __name__ == '__main__':
+    main()
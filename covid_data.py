@@ -1,52 +1,30 @@
 import requests
-import sqlite3
 import json
 import os
-from bs4 import BeautifulSoup
-import matplotlib.pyplot as plt
+import argparse
+import time
+import codecs
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import csv
+from database import setUpDatabase, create_tables, load_states, BatchWriter
+from http_cache import ResponseCache
+import queries
+import derived_metrics
+import instrument
 
 #
 # Name: Mingxuan Sun
 # Who did you work with: Tiara Amadia
 #
 
-def setUpDatabase(db_name):
-    '''This function takes in the name of the database, makes a connection to server
-    using name given, and returns cur and conn as the cursor and connection variable
-    to allow database access.'''
-    
-    path = os.path.dirname(os.path.abspath(__file__))
-    conn = sqlite3.connect(path+'/'+db_name)
-    cur = conn.cursor()
-    return cur, conn
-
-def state_table(cur, conn):
-    '''Takes in the cur and conn variables. Creates a table called States that has lowercase
-    abbreviations for all 50 states and a state_id primary key for each.'''
-    states_list_1 = ['al', 'ak', 'az', 'ar', 'ca', 'co', 'ct', 'de', 'fl', 'ga', 'hi', 'id', 'il', 'in', 'ia', 'ks', 'ky', 'la', 'me', 'md', 'ma', 'mi', 'mn', 'ms', 'mo']
-    states_list_2 = ['mt', 'ne', 'nv', 'nh', 'nj', 'nm', 'ny', 'nc', 'nd', 'oh', 'ok', 'or', 'pa', 'ri', 'sc', 'sd', 'tn', 'tx', 'ut', 'vt', 'va', 'wa', 'wv', 'wi', 'wy']
-
-    cur.execute('CREATE TABLE IF NOT EXISTS States ("state_id" INTEGER PRIMARY KEY, "state" TEXT)')
-    #avoids inserting values multiple times
-    cur.execute('SELECT MAX(state_id) FROM States')
-    data = cur.fetchone()
-    num = data[0]
-    if type(num) == int:
-        return
-
-    for state in states_list_1:
-        cur.execute('INSERT INTO States (state) VALUES (?)', [state])
-        conn.commit()
-    
-    for state in states_list_2:
-        cur.execute('INSERT INTO States (state) VALUES (?)', [state])
-        conn.commit()
+API_URL = "https://api.covidtracking.com/v1/states"
 
 def date_table(cur, conn):
-    '''Takes in the cur and conn variables. Creates a table called Dates that holds the two date values
-     and a date_id primary key for each.'''
-    cur.execute('CREATE TABLE IF NOT EXISTS Dates ("date_id" INTEGER PRIMARY KEY, "date" TEXT)')
+    '''Takes in the cur and conn variables. Adds the report's two dates (Dec 1st 2020 and Mar 7th 2021) to
+    the Dates table made by create_tables, each with a date_id primary key, unless it already holds dates.
+    Returns nothing.'''
     #avoids inserting values multiple times
     cur.execute('SELECT MAX(date_id) FROM Dates')
     data = cur.fetchone()
@@ -60,181 +38,485 @@ def date_table(cur, conn):
     cur.execute('INSERT INTO Dates (date) VALUES (?)', [date_2])
     conn.commit()
 
-def covid_table(cur, conn, state, date, positive):
+#upsert: a (state_id, date_id) that is already stored is only rewritten if its value changed
+COVID_INSERT = '''INSERT INTO CovidData (state_id, date_id, number_of_cases) VALUES (?, ?, ?)
+    ON CONFLICT (state_id, date_id) DO UPDATE SET number_of_cases = excluded.number_of_cases
+    WHERE number_of_cases IS NOT excluded.number_of_cases'''
+#upsert: one value per (state_id, date_id, metric_id), only rewritten if it changed
+METRIC_INSERT = '''INSERT INTO CovidMetrics (state_id, date_id, metric_id, value) VALUES (?, ?, ?, ?)
+    ON CONFLICT (state_id, date_id, metric_id) DO UPDATE SET value = excluded.value
+    WHERE value IS NOT excluded.value'''
+#fields of the API's daily records stored in CovidMetrics by default
+DEFAULT_METRICS = ('positive', 'negative', 'death', 'totalTestResults', 'hospitalizedCurrently')
+PERCENT_CHANGE_INSERT = '''INSERT INTO PercentChange (state_id, percent_change) VALUES (?, ?)
+    ON CONFLICT (state_id) DO UPDATE SET percent_change = excluded.percent_change
+    WHERE percent_change IS NOT excluded.percent_change'''
+#PercentChange holds the report's window only; percent changes over other dates are stored by period
+REPORT_DATES = (20201201, 20210307)
+DERIVED_INSERT = '''INSERT INTO DerivedMetrics (state_id, metric, period, value) VALUES (?, ?, ?, ?)
+    ON CONFLICT (state_id, metric, period) DO UPDATE SET value = excluded.value
+    WHERE value IS NOT excluded.value'''
+
+def covid_table(cur, conn, state, date, positive, writer=None):
     #STATE MUST BE LOWERCASE
     '''This function takes in cursor and connection variables to database, state,
-    date, and number of positive COVID cases for that state. It creates a table in the database
-    if it doesn't exist and inserts the state, date, and number of positive cases. Returns nothing.'''
+    date, and number of positive COVID cases for that state, and optionally a BatchWriter for
+    COVID_INSERT. Writing a (state, date) that is already stored updates it instead of adding a
+    duplicate. The row is buffered in the writer if one is given, otherwise it is inserted and
+    committed right away. The table must already exist (see create_tables). Returns nothing.'''
 
-    cur.execute('CREATE TABLE IF NOT EXISTS CovidData ("id" INTEGER PRIMARY KEY, "state_id" NUMBER, "date_id" NUMBER, "number_of_cases" NUMBER)')
-    cur.execute('INSERT INTO CovidData (state_id, date_id, number_of_cases) VALUES (?, ?, ?)', (state, date, positive))
+    if writer is not None:
+        writer.add((state, date, positive))
+        return
+    cur.execute(COVID_INSERT, (state, date, positive))
     conn.commit()
 
-def percent_change_table(cur, conn, state_id, percent):
+def metrics_table(cur, conn, state_id, date_id, day, metric_ids, writer=None):
+    '''This function takes in cursor and connection variables to database, the state_id and date_id, one
+    record of the API (a dictionary of field to value), a dictionary of metric name to metric_id (see
+    metric_ids) and optionally a BatchWriter for METRIC_INSERT. Upserts one CovidMetrics row per metric the
+    record has a value for; the API's null values are left out rather than stored. Rows are buffered in the
+    writer if one is given, otherwise they are written and committed right away. Returns nothing.'''
+
+    rows = [(state_id, date_id, metric_id, day.get(name)) for name, metric_id in metric_ids.items() if day.get(name) is not None]
+    if writer is not None:
+        writer.add_many(rows)
+        return
+    cur.executemany(METRIC_INSERT, rows)
+    conn.commit()
+
+def percent_change_table(cur, conn, state_id, percent, writer=None):
     #STATE MUST BE LOWERCASE
     '''This function takes in cursor and connection variables to database, state,
-    and percent change calculated from percent_change. It creates a table in the database
-    if it doesn't exist and inserts the state and percent change. Returns nothing.'''
+    and percent change calculated from percent_change, and optionally a BatchWriter for
+    PERCENT_CHANGE_INSERT. A state that is already stored gets its value updated instead of a second
+    row. The row is buffered in the writer if one is given, otherwise it is
+    inserted and committed right away. The table must already exist (see create_tables). Returns nothing.'''
 
-    cur.execute('CREATE TABLE IF NOT EXISTS PercentChange ("state_id" NUMBER, "percent_change" NUMBER)')
-    cur.execute('INSERT INTO PercentChange (state_id, percent_change) VALUES (?, ?)', (state_id, percent))
+    if writer is not None:
+        writer.add((state_id, percent))
+        return
+    cur.execute(PERCENT_CHANGE_INSERT, (state_id, percent))
     conn.commit()
 
-def covid_table_length(cur, conn):
-    '''This function calculates the number of rows in the CovidData table to help with extracting
-    25 lines at a time. Returns the number of rows in the table as an int.'''
-    cur.execute('CREATE TABLE IF NOT EXISTS CovidData ("id" INTEGER PRIMARY KEY, "state_id" TEXT, "date_id" NUMBER, "number_of_cases" NUMBER)')
-    cur.execute('SELECT MAX(id) FROM CovidData')
-    data = cur.fetchone()
-    num = data[0]
-    return num
-
 ##################################################################
 
-def get_mar_data(cur, conn, state, state_id, date_id):
-    '''This function takes in the cursor and connection variables, and the lowercase state abbreviation.
-    It sends requests to COVID Tracking Project API for the latest data for the given state (mostly March 7th 2021, as that's when
-    the project ended). Uses json to extract date and number of positive cases. Calls covid_table to create and add to table.
-    Returns nothing.'''
-    
-    url_2021 = f"https://api.covidtracking.com/v1/states/{state}/current.json"
-    req = requests.get(url_2021)
-    curr_info = json.loads(req.text)
-
-    #extract date and positive cases
-    curr_date = curr_info["date"]
-    curr_positive = curr_info["positive"]
-
-    if curr_positive == 'null':
-        print("2021 info not found")
-
-    #add to table
-    covid_table(cur, conn, state_id, date_id, curr_positive)
-
-def get_dec_data(cur, conn, state, state_id, date_id):
-    '''This function takes in the cursor and connection variables, and the lowercase state abbreviation.
-    It sends requests to COVID Tracking Project API for Dec 1st, 2020 data for the given state.
-    Uses json to extract date and number of positive cases. Calls covid_table to create and add to table.
-    Returns nothing.'''
-    url = f"https://api.covidtracking.com/v1/states/{state}/daily.json"
-    req = requests.get(url)
-    curr_info = json.loads(req.text)
-    curr_info.reverse()
-
-    dec_1_2020 = 20201201
-    positive = 0
-
-    #extract positive cases
-    for day in curr_info:
-        if day["date"] == dec_1_2020:
-            positive = day["positive"]
-
-    if positive == 'null':
-        print("Jul info not found")
+def make_session(max_workers=10):
+    '''Takes in the number of worker threads that will share the session. Returns a requests Session
+    whose keep-alive connection pool is big enough that every worker can reuse an open connection
+    instead of doing a new TCP/TLS handshake per request.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_json(session, url, timeout=10, retries=3, backoff=0.5, cache=None):
+    '''Takes in a session, a url, a per-request timeout in seconds, the number of retries, the base
+    backoff in seconds and optionally a ResponseCache. Sends a GET request (through the cache if one
+    is given) and returns the decoded json. Connection errors, timeouts, 429 and 5xx responses are
+    retried with exponential backoff (backoff, 2*backoff, 4*backoff...). Other http errors are raised
+    right away.'''
+    for attempt in range(retries + 1):
+        try:
+            if cache is not None:
+                status, body = cache.fetch(session, url, timeout)
+            else:
+                req = session.get(url, timeout=timeout)
+                status, body = req.status_code, req.content
+                instrument.count('requests')
+                instrument.count('bytes', len(body))
+            if status != 429 and status < 500:
+                if status >= 400:
+                    raise requests.HTTPError(f"{status} error for url: {url}")
+                return json.loads(body)
+            error = requests.HTTPError(f"{status} error for url: {url}")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    raise error
+
+def fetch_all_states(states_list, base_url=API_URL, max_workers=10, timeout=10, retries=3, backoff=0.5,
+                     files=('current.json', 'daily.json'), cache=None):
+    '''Takes in a list of lowercase state abbreviations, the base url of the API, the fetch settings
+    (including an optional ResponseCache) and the json files to download per state. Downloads every file for every state at the same time using a
+    pool of at most max_workers threads sharing one keep-alive session, so the whole refresh takes about
+    as long as the slowest request. Returns a dictionary with state as key and a tuple of the decoded
+    files (in the order of files, by default (current, daily)) as value.'''
+    session = make_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for state in states_list:
+                futures[state] = [pool.submit(fetch_json, session, f"{base_url}/{state}/{name}", timeout, retries, backoff, cache)
+                                  for name in files]
+
+            results = {}
+            for state in states_list:
+                results[state] = tuple(future.result() for future in futures[state])
+    finally:
+        session.close()
+    return results
+
+def date_ids(cur, conn, dates):
+    '''Takes in the cursor and connection variables and an iterable of dates as YYYYMMDD ints. Adds any
+    date missing from the Dates table (without committing, so it can share the caller's transaction).
+    Returns a dictionary with the date int as key and its date_id as value.'''
+    cur.execute('SELECT date, date_id FROM Dates')
+    ids = {int(row[0]): row[1] for row in cur.fetchall()}
+
+    missing = sorted(set(dates) - set(ids))
+    cur.executemany('INSERT INTO Dates (date) VALUES (?)', [(str(date),) for date in missing])
+
+    if missing:
+        cur.execute('SELECT date, date_id FROM Dates')
+        ids = {int(row[0]): row[1] for row in cur.fetchall()}
+    return ids
+
+def metric_ids(cur, conn, names):
+    '''Takes in the cursor and connection variables and an iterable of API field names. Adds any name
+    missing from MetricTypes (without committing). Returns a dictionary with the name as key and its
+    metric_id as value.'''
+    cur.executemany('INSERT OR IGNORE INTO MetricTypes (name) VALUES (?)', [(name,) for name in names])
+    cur.execute('SELECT name, metric_id FROM MetricTypes')
+    ids = dict(cur.fetchall())
+    return {name: ids[name] for name in names}
+
+def new_metrics(cur, conn, names):
+    '''Takes in the cursor and connection variables and an iterable of API field names. Returns the ones
+    that have never been stored, whose history has to be read again from the start.'''
+    cur.execute('SELECT name FROM MetricTypes')
+    known = set(row[0] for row in cur.fetchall())
+    return [name for name in names if name not in known]
+
+def latest_dates(cur, conn):
+    '''Takes in the cursor and connection variables. Returns a dictionary with state_id as key and the
+    newest date stored in CovidData for that state (as a YYYYMMDD int) as value.'''
+    cur.execute('SELECT CovidData.state_id, MAX(CAST(Dates.date AS INTEGER)) FROM CovidData JOIN Dates ON CovidData.date_id = Dates.date_id GROUP BY CovidData.state_id')
+    return {row[0]: row[1] for row in cur.fetchall()}
+
+def sync(cur, conn, states_list, metrics=DEFAULT_METRICS, **fetch_options):
+    '''Takes in the cursor and connection variables, the full list of lowercase state abbreviations (each
+    written under its state_id in the States table), the API fields to store in CovidMetrics and optional
+    fetch settings passed on to fetch_all_states (base_url, max_workers, timeout, retries, backoff, cache).
+    Brings CovidData and CovidMetrics up to date in one run: current.json is fetched for every state,
+    daily.json only for the states whose latest stored date is older than the API's, and only the days newer
+    than what is stored are upserted, all in a single transaction. Adding a metric that was never stored
+    reads every day again once. Running it again on an up to date database writes nothing. Returns the
+    number of CovidData rows written.'''
+    cur.execute('SELECT state, state_id FROM States')
+    state_ids = dict(cur.fetchall())
+    latest = latest_dates(cur, conn)
+    if new_metrics(cur, conn, metrics):
+        latest = {}
+    with instrument.stage('fetch_covid'):
+        current = fetch_all_states(states_list, files=('current.json',), **fetch_options)
+
+    behind = [state for state in states_list if current[state][0]["date"] > latest.get(state_ids[state], 0)]
+    if not behind:
+        return 0
+    with instrument.stage('fetch_covid'):
+        daily = fetch_all_states(behind, files=('daily.json',), **fetch_options)
+
+    new_days = {}
+    for state in behind:
+        since = latest.get(state_ids[state], 0)
+        #oldest day first so new date ids follow the calendar
+        new_days[state_ids[state]] = [day for day in reversed(daily[state][0]) if day["date"] > since]
+
+    with instrument.stage('write_covid'), BatchWriter(cur, conn, COVID_INSERT) as writer, BatchWriter(cur, conn, METRIC_INSERT) as metric_writer:
+        ids = date_ids(cur, conn, set(day["date"] for days in new_days.values() for day in days))
+        metric_id = metric_ids(cur, conn, metrics)
+
+        for state_id, days in new_days.items():
+            for day in days:
+                covid_table(cur, conn, state_id, ids[day["date"]], day["positive"], writer)
+                metrics_table(cur, conn, state_id, ids[day["date"]], day, metric_id, metric_writer)
+        writer.flush()
+    return writer.changed
+
+class TruncatedJSON(ValueError):
+    '''Raised by iter_json_array when the chunks end before the array does, e.g. a dropped download.'''
+
+def iter_json_array(chunks):
+    '''Takes in an iterable of text chunks that together hold one JSON array of objects (like daily.json).
+    Yields the objects one at a time as soon as each is complete, so only the current chunk and the
+    object being read are held in memory instead of the whole payload.'''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                #the object continues in the next chunk
+                break
+            yield item
+        buffer = buffer[pos:]
+    raise TruncatedJSON("JSON array ended early")
+
+def stream_records(session, url, fields=('positive',), timeout=10, chunk_size=64 * 1024):
+    '''Takes in a session, the url of a JSON array of daily records, the record fields to keep, a timeout
+    in seconds and the read size in bytes. Streams the response and parses it incrementally with
+    iter_json_array. Yields one dictionary per record holding date and the given fields (None where the
+    API has no value).'''
+    instrument.count('requests')
+    with session.get(url, stream=True, timeout=timeout) as req:
+        req.raise_for_status()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+        def decode(chunk):
+            instrument.count('bytes', len(chunk))
+            return decoder.decode(chunk)
+
+        chunks = (decode(chunk) for chunk in req.iter_content(chunk_size=chunk_size))
+        for day in iter_json_array(chunks):
+            record = {'date': day['date']}
+            for field in fields:
+                record[field] = day.get(field)
+            yield record
+
+@instrument.timed('stream_covid')
+def stream_sync(cur, conn, states_list, batch_size=1000, base_url=API_URL, max_workers=10, timeout=10, retries=3, backoff=0.5, metrics=DEFAULT_METRICS):
+    '''Takes in the cursor and connection variables, the full list of lowercase state abbreviations (each
+    written under its state_id in the States table), the insert batch size and the fetch settings. Does the
+    same job as sync() for a full backfill but never holds a whole daily.json in memory: every state's file
+    is streamed and parsed record by record in a worker thread, and the records go through a queue of at most
+    batch_size items to this thread, which upserts them with a BatchWriter of batch_size rows in a single
+    transaction. Since daily.json is newest first, reading a state stops at its latest stored date. A download
+    that fails or is cut off is read again from the start. The given API fields are stored in CovidMetrics as
+    well. The response cache is not used. Returns the number of CovidData rows written.'''
+    cur.execute('SELECT state, state_id FROM States')
+    state_ids = dict(cur.fetchall())
+    latest = latest_dates(cur, conn)
+    if new_metrics(cur, conn, metrics):
+        latest = {}
+    metric_id = metric_ids(cur, conn, metrics)
+    fields = ('positive',) + tuple(name for name in metrics if name != 'positive')
+    cur.execute('SELECT date, date_id FROM Dates')
+    ids = {int(row[0]): row[1] for row in cur.fetchall()}
+
+    records = queue.Queue(maxsize=batch_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(state_id, state):
+        since = latest.get(state_id, 0)
+        url = f"{base_url}/{state}/daily.json"
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    for day in stream_records(session, url, fields, timeout):
+                        if day["date"] <= since or not put((state_id, day)):
+                            break
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                        requests.exceptions.ChunkedEncodingError, TruncatedJSON) as e:
+                    #a download cut off mid-body is retried too; records already queued are upserted
+                    #again on retry, which changes nothing
+                    response = getattr(e, 'response', None)
+                    status = response.status_code if response is not None else None
+                    retryable = status is None or status == 429 or status >= 500
+                    if attempt == retries or not retryable:
+                        raise
+                    time.sleep(backoff * 2 ** attempt)
+            put((state_id, None))
+        except Exception as e:
+            put((state_id, e))
+
+    session = make_session(max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            with BatchWriter(cur, conn, COVID_INSERT, batch_size) as writer, BatchWriter(cur, conn, METRIC_INSERT, batch_size) as metric_writer:
+                for state in states_list:
+                    pool.submit(produce, state_ids[state], state)
+
+                try:
+                    done = 0
+                    while done < len(states_list):
+                        state_id, day = records.get()
+                        if day is None:
+                            done += 1
+                            continue
+                        if isinstance(day, Exception):
+                            raise day
+
+                        if day["date"] not in ids:
+                            cur.execute('INSERT INTO Dates (date) VALUES (?)', (str(day["date"]),))
+                            ids[day["date"]] = cur.lastrowid
+                        covid_table(cur, conn, state_id, ids[day["date"]], day["positive"], writer)
+                        metrics_table(cur, conn, state_id, ids[day["date"]], day, metric_id, metric_writer)
+                finally:
+                    stop.set()
+                writer.flush()
+    finally:
+        session.close()
+    return writer.changed
+
+@instrument.timed('percent_change')
+def percent_change(cur, conn, states_list, start_date=20201201, end_date=20210307):
+    '''This function takes in cursor and connection variables, a list of lowercase state abbreviations and
+    optionally the two dates to compare as YYYYMMDD ints (Dec 1st 2020 and Mar 7th 2021 by default).
+    It calculates the percent change in number of COVID cases between the two dates for every given state
+    in a single query that self joins CovidData on the two dates, and adds the results with executemany to
+    PercentChange for the report's dates, or to DerivedMetrics under their period (see derived_metrics.add_window,
+    which keeps the window up to date) for any others. Returns a list with the percent changes in the order of states_list (None for a state
+    missing either date or with 0 cases on the first one).'''
 
-    #add to table
-    covid_table(cur, conn, state_id, date_id, positive)
-
-def percent_change(cur, conn, states_list):
-    '''This function takes in cursor and connection variables, and the lowercase state abbreviation.
-    It calculates the percent change from Dec 2020 to Mar 2021 in number of COVID cases for the given state.
-    Returns a list with all the percent changes.'''
-    
     #JOIN HERE
-    cur.execute('SELECT States.state, Dates.date, CovidData.number_of_cases FROM CovidData JOIN States JOIN Dates ON CovidData.state_id = States.state_id and CovidData.date_id = Dates.date_id')
-    cases = cur.fetchall()
-
-    percent_list = []
-
-    i = 1
-    for state in states_list:
-        cases_list = []
-        for row in cases:
-            if row[0] == state:
-                cases_list.append(row[2])
-        positive_dec = cases_list[0]
-        positive_mar = cases_list[1]
-    
-        percent = (positive_mar - positive_dec) / positive_dec * 100
-        percent_change_table(cur, conn, i, percent)
-
-        percent_list.append(percent)
-        i += 1
-    
-    return percent_list
+    placeholders = ', '.join('?' * len(states_list))
+    cur.execute(f'''SELECT States.state, States.state_id,
+            (end_cases.number_of_cases - start_cases.number_of_cases) * 100.0 / NULLIF(start_cases.number_of_cases, 0)
+        FROM CovidData AS start_cases
+        JOIN Dates AS start_dates ON start_dates.date_id = start_cases.date_id AND start_dates.date = ?
+        JOIN CovidData AS end_cases ON end_cases.state_id = start_cases.state_id
+        JOIN Dates AS end_dates ON end_dates.date_id = end_cases.date_id AND end_dates.date = ?
+        JOIN States ON States.state_id = start_cases.state_id
+        WHERE States.state IN ({placeholders})''', [str(start_date), str(end_date)] + list(states_list))
+    rows = cur.fetchall()
+
+    if (start_date, end_date) == REPORT_DATES:
+        with BatchWriter(cur, conn, PERCENT_CHANGE_INSERT) as writer:
+            for state, state_id, percent in rows:
+                percent_change_table(cur, conn, state_id, percent, writer)
+    else:
+        #stored so derived_metrics.refresh() recomputes the window once the cases change
+        period = derived_metrics.add_window(cur, conn, 'percent_change', (start_date, end_date))
+        with BatchWriter(cur, conn, DERIVED_INSERT) as writer:
+            for state, state_id, percent in rows:
+                writer.add((state_id, 'percent_change', period, percent))
+
+    percents = {state: percent for state, state_id, percent in rows}
+    return [percents.get(state) for state in states_list]
+
+@instrument.timed('rolling_percent_change')
+def rolling_percent_change(cur, conn, periods=1, states_list=None, start_date=None, end_date=None):
+    '''This function takes in cursor and connection variables, the number of days to compare over (1 for
+    day-over-day change), and optionally a list of lowercase state abbreviations and a YYYYMMDD date range
+    to return. It calculates the percent change in number of COVID cases against the value stored
+    for the date periods days earlier for every stored day of every state in one query that joins CovidData
+    to itself on that date, so the earlier value is found even when it falls before start_date and gaps in
+    the dates don't shift the comparison. Returns a list of (state, date, cases, percent change) tuples
+    ordered by state_id and date; percent change is None where there is no value on the earlier date.'''
+    conditions = []
+    params = [f"-{int(periods)} days"]
+    if states_list is not None:
+        conditions.append(f"States.state IN ({', '.join('?' * len(states_list))})")
+        params += list(states_list)
+    if start_date is not None:
+        conditions.append('Dates.date >= ?')
+        params.append(str(start_date))
+    if end_date is not None:
+        conditions.append('Dates.date <= ?')
+        params.append(str(end_date))
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    #YYYYMMDD -> YYYY-MM-DD, moved back by periods days, -> YYYYMMDD
+    cur.execute(f'''SELECT States.state, CAST(Dates.date AS INTEGER), CovidData.number_of_cases,
+            (CovidData.number_of_cases - earlier.number_of_cases) * 100.0 / NULLIF(earlier.number_of_cases, 0)
+        FROM CovidData JOIN States ON CovidData.state_id = States.state_id JOIN Dates ON CovidData.date_id = Dates.date_id
+        LEFT JOIN Dates AS earlier_dates ON earlier_dates.date = strftime('%Y%m%d', substr(Dates.date, 1, 4) || '-' || substr(Dates.date, 5, 2) || '-' || substr(Dates.date, 7, 2), ?)
+        LEFT JOIN CovidData AS earlier ON earlier.state_id = CovidData.state_id AND earlier.date_id = earlier_dates.date_id
+        {where} ORDER BY CovidData.state_id, Dates.date''', params)
+    return cur.fetchall()
+
+@instrument.timed('write_csv')
+def write_to_file(filename, cur, conn, states_list, metrics=None):
+    '''Takes in a filename, cur and conn variables, a list of state abbreviations and optionally a frame
+    from analytics.state_metrics (by default the precomputed values in DerivedMetrics are read after an
+    incremental refresh). Stores the percent change in COVID cases of each state in PercentChange, and
+    writes to a csv file the column headers and values of state abbreviations and percent change.'''
+    if metrics is None:
+        derived_metrics.refresh(cur, conn)
+        stored = queries.metric_values(cur, 'percent_change', derived_metrics.window(20201201, 20210307))
+        values = {state: value for state, name, value in stored}
+    else:
+        values = metrics['percent_change'].astype(object).where(metrics['percent_change'].notna(), None).to_dict()
+    percents = [values.get(state) for state in states_list]
+
+    cur.execute('SELECT state, state_id FROM States')
+    state_ids = dict(cur.fetchall())
+    with BatchWriter(cur, conn, PERCENT_CHANGE_INSERT) as writer:
+        for state, percent in zip(states_list, percents):
+            if state in state_ids:
+                percent_change_table(cur, conn, state_ids[state], percent, writer)
 
-def write_to_file(filename, cur, conn, states_list):
-    '''Takes in a filename, cur and conn variables, and a list of state abbreviations.
-    Writes to a csv file the column headers and values of state abbreviations and percent
-    change in COVID cases as calculated in percent_change().'''
     path = os.path.dirname(os.path.abspath(__file__)) + os.sep
     write_file = open(path + filename, "w")
     write = csv.writer(write_file, delimiter=",")
     write.writerow(('State','Percent Change COVID Cases'))
 
-    percent_list = percent_change(cur, conn, states_list)
-
-    for i in range(50):
-        values = [states_list[i], percent_list[i]]
+    for state, percent in zip(states_list, percents):
+        values = [state, percent]
         write.writerow(values)
 
     write_file.close()
 
-def main():
-    '''Main includes two state abbreviation lists with 25 states in each. It calls covid_table_length() and
-    uses the results to determine what set of data to collect, storing 25 rows each time until CovidData is
-    populated with 100 rows. Then calculates and populates PercentChange, and writes calculations to csv file.
+def main(offline=False, stream=False, report=None, profile_dir=None):
+    '''Main reads the lowercase abbreviations of every state, DC and territory from states.csv. It calls sync() to bring CovidData
+    up to date with the COVID Tracking Project API in a single run, fetching only what is missing and
+    going through the on-disk response cache (only the cache if offline is True). With stream True it
+    calls stream_sync() instead, which keeps memory bounded for big backfills but always reads from the
+    network, so it can't be combined with offline (ValueError). Then calculates and
+    populates PercentChange, and writes calculations to csv file. If report is given the stage timings
+    and counters of the run are saved there as JSON, and with profile_dir every stage is also profiled.
     Returns nothing.'''
+    if offline and stream:
+        raise ValueError("stream_sync() streams from the network and can't run offline")
+    instrument.reset(profile_dir)
     cur, conn = setUpDatabase("finalProject.db")
 
-    state_table(cur, conn)
+    create_tables(cur, conn)
     date_table(cur, conn)
 
-    states_list_1 = ['al', 'ak', 'az', 'ar', 'ca', 'co', 'ct', 'de', 'fl', 'ga', 'hi', 'id', 'il', 'in', 'ia', 'ks', 'ky', 'la', 'me', 'md', 'ma', 'mi', 'mn', 'ms', 'mo']
-    states_list_2 = ['mt', 'ne', 'nv', 'nh', 'nj', 'nm', 'ny', 'nc', 'nd', 'oh', 'ok', 'or', 'pa', 'ri', 'sc', 'sd', 'tn', 'tx', 'ut', 'vt', 'va', 'wa', 'wv', 'wi', 'wy']
-    full_states_list = ['al', 'ak', 'az', 'ar', 'ca', 'co', 'ct', 'de', 'fl', 'ga', 'hi', 'id', 'il', 'in', 'ia', 'ks', 'ky', 'la', 'me', 'md', 'ma', 'mi', 'mn', 'ms', 'mo', 'mt', 'ne', 'nv', 'nh', 'nj', 'nm', 'ny', 'nc', 'nd', 'oh', 'ok', 'or', 'pa', 'ri', 'sc', 'sd', 'tn', 'tx', 'ut', 'vt', 'va', 'wa', 'wv', 'wi', 'wy']
-
-    num = covid_table_length(cur, conn)
-    if num == None:
-        print("1")
-        state_id = 1
-        date_id = 1
-        for state in states_list_1:
-            get_dec_data(cur, conn, state, state_id, date_id)
-            state_id += 1
-        return
+    full_states_list = [state for state, name in load_states()]
+
+    if stream:
+        written = stream_sync(cur, conn, full_states_list)
+    else:
+        cache = ResponseCache(offline=offline)
+        written = sync(cur, conn, full_states_list, cache=cache)
+        cache.close()
+    print(f"{written} rows written")
 
-    elif type(num) == int:
-        if num <= 25:
-            print("2")
-            state_id = 26
-            date_id = 1
-            for state in states_list_2:
-                get_dec_data(cur, conn, state, state_id, date_id)
-                state_id += 1
-            return
-
-        if num <= 50:
-            print("3")
-            state_id = 1
-            date_id = 2
-            for state in states_list_1:
-                get_mar_data(cur, conn, state, state_id, date_id)
-                state_id += 1
-            return
-    
-        if num <= 75:
-            print("4")
-            state_id = 26
-            date_id = 2
-            for state in states_list_2:
-                get_mar_data(cur, conn, state, state_id, date_id)
-                state_id += 1
-
-    print("percent calculation")
     write_to_file('covid_calculations.csv', cur, conn, full_states_list)
 
     cur.close()
+    if report is not None:
+        instrument.write_report(report)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Bring CovidData up to date and write covid_calculations.csv.')
+    parser.add_argument('--offline', action='store_true', help='answer every request from the response cache')
+    parser.add_argument('--stream', action='store_true', help='stream daily.json for big backfills')
+    parser.add_argument('--report', metavar='PATH', help='save stage timings and counters as JSON to PATH')
+    parser.add_argument('--profile', metavar='DIR', help='save a cProfile dump of every stage to DIR')
+    args = parser.parse_args()
+    if args.offline and args.stream:
+        parser.error("--stream reads from the network and can't be combined with --offline")
+    main(args.offline, args.stream, args.report, args.profile)
\ No newline at end of file
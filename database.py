@@ -0,0 +1,339 @@
+import sqlite3
+import os
+import csv
+import queue
+import pathlib
+import threading
+from contextlib import contextmanager
+import instrument
+
+#
+# Shared database setup and write layer used by covid_data.py, population_data.py and viz.py
+#
+
+JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+def setUpDatabase(db_name, journal_mode='WAL', synchronous='NORMAL', timeout=5.0, check_same_thread=True, read_only=False):
+    '''This function takes in the name of the database and optionally the sqlite journal mode and
+    synchronous setting, how many seconds to wait for another writer's lock, whether the connection
+    is tied to the thread that made it and whether it may only read. It makes a connection to server using name given (relative to this folder unless
+    it is an absolute path), and returns cur and conn as the cursor and connection variable to allow
+    database access. WAL with synchronous NORMAL only fsyncs at checkpoints instead of on every commit.
+    A read-only connection keeps the journal mode the database already has and fails if it doesn't exist.'''
+    journal_mode = journal_mode.upper()
+    synchronous = synchronous.upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"journal_mode must be one of {JOURNAL_MODES}")
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"synchronous must be one of {SYNCHRONOUS_MODES}")
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), db_name)
+    if read_only:
+        conn = sqlite3.connect(pathlib.Path(path).as_uri() + '?mode=ro', timeout=timeout, check_same_thread=check_same_thread, uri=True)
+    else:
+        conn = sqlite3.connect(path, timeout=timeout, check_same_thread=check_same_thread)
+        conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+        conn.execute(f'PRAGMA synchronous = {synchronous}')
+    cur = conn.cursor()
+    return cur, conn
+
+POPULATION_SCHEMA = '''CREATE TABLE IF NOT EXISTS Population ("id" INTEGER PRIMARY KEY,
+    "state_id" INTEGER REFERENCES States (state_id), "year" INTEGER, "population" INTEGER,
+    UNIQUE (state_id, year))'''
+
+def create_tables(cur, conn):
+    '''Takes in the cur and conn variables. Creates every table the project writes to if it doesn't
+    exist yet, so the insert helpers don't have to run CREATE TABLE for every row, fills States and
+    upgrades databases made by older versions of the scripts. Returns nothing.'''
+    cur.execute('CREATE TABLE IF NOT EXISTS States ("state_id" INTEGER PRIMARY KEY, "state" TEXT, "name" TEXT)')
+    cur.execute('CREATE TABLE IF NOT EXISTS Dates ("date_id" INTEGER PRIMARY KEY, "date" TEXT)')
+    cur.execute('CREATE INDEX IF NOT EXISTS Dates_date ON Dates (date)')
+    cur.execute('CREATE TABLE IF NOT EXISTS CovidData ("id" INTEGER PRIMARY KEY, "state_id" NUMBER, "date_id" NUMBER, "number_of_cases" NUMBER)')
+    cur.execute('CREATE INDEX IF NOT EXISTS CovidData_date ON CovidData (date_id, number_of_cases)')
+    cur.execute('CREATE TABLE IF NOT EXISTS PercentChange ("state_id" NUMBER, "percent_change" NUMBER)')
+    cur.execute(POPULATION_SCHEMA)
+    cur.execute('CREATE TABLE IF NOT EXISTS MetricTypes ("metric_id" INTEGER PRIMARY KEY, "name" TEXT UNIQUE)')
+    #one row per stored value, clustered on the key instead of a rowid to keep it small
+    cur.execute('''CREATE TABLE IF NOT EXISTS CovidMetrics ("state_id" INTEGER, "date_id" INTEGER, "metric_id" INTEGER,
+        "value" INTEGER, PRIMARY KEY (state_id, date_id, metric_id)) WITHOUT ROWID''')
+    cur.execute('CREATE INDEX IF NOT EXISTS CovidMetrics_metric ON CovidMetrics (metric_id, date_id, value)')
+    rollup_tables(cur, conn)
+    state_table(cur, conn)
+    unique_keys(cur, conn)
+    migrate_population(cur, conn)
+    cur.execute('CREATE INDEX IF NOT EXISTS Population_year ON Population (year)')
+    cur.execute('CREATE TABLE IF NOT EXISTS PipelineState ("stage" TEXT PRIMARY KEY, "fingerprint" TEXT, "finished_at" TEXT)')
+    metrics_tables(cur, conn)
+    dirty_triggers(cur, conn)
+    cur.execute('CREATE TABLE IF NOT EXISTS TimeSeries ("metric" TEXT PRIMARY KEY, "start_date" INTEGER, "days" INTEGER, "states" INTEGER)')
+    conn.commit()
+
+#the top of the region hierarchy; every area in states.csv belongs to it
+NATION = 'United States'
+
+def load_areas():
+    '''Reads states.csv, which lists every state, DC and territory in state_id order with its
+    lowercase abbreviation, full name, type (state, district or territory) and census region (empty
+    for the territories, which are in none). Returns a list of dictionaries with those keys.'''
+    path = os.path.dirname(os.path.abspath(__file__))
+    with open(path + '/states.csv', newline='') as f:
+        return list(csv.DictReader(f))
+
+def load_states():
+    '''Reads states.csv. Returns a list of (state, name) tuples for every state, DC and territory in
+    state_id order.'''
+    return [(area['state'], area['name']) for area in load_areas()]
+
+def state_table(cur, conn):
+    '''Takes in the cur and conn variables. Fills the States table with the lowercase abbreviation, full
+    name, type and region_id of every state, DC and territory in states.csv, with a state_id primary key
+    for each, and the Regions and RegionMembers tables with the hierarchy above them: the nation, the
+    census regions and which of them every area rolls up into. States already in the table keep their
+    state_id; older databases get the new columns filled in. If any area moved, the stored rollups are
+    cleared so rollups.refresh() rebuilds them. Returns nothing.'''
+    cur.execute('PRAGMA table_info(States)')
+    columns = [row[1] for row in cur.fetchall()]
+    for column, kind in (('name', 'TEXT'), ('type', 'TEXT'), ('region_id', 'INTEGER')):
+        if column not in columns:
+            cur.execute(f'ALTER TABLE States ADD COLUMN "{column}" {kind}')
+
+    areas = load_areas()
+    cur.execute("INSERT OR IGNORE INTO Regions (name, level) VALUES (?, 'nation')", (NATION,))
+    cur.executemany("INSERT OR IGNORE INTO Regions (name, level, parent_id) SELECT ?, 'region', region_id FROM Regions WHERE name = ?",
+                    [(region, NATION) for region in sorted(set(area['region'] for area in areas if area['region']))])
+    cur.execute('SELECT name, region_id FROM Regions')
+    region_ids = dict(cur.fetchall())
+
+    rows = [(area['state'], area['name'], area['type'], region_ids.get(area['region'])) for area in areas]
+    cur.executemany('INSERT INTO States (state, name, type, region_id) SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM States WHERE state = ?)',
+                    [row + (row[0],) for row in rows])
+    cur.executemany('UPDATE States SET name = ?, type = ?, region_id = ? WHERE state = ? AND (name IS NOT ? OR type IS NOT ? OR region_id IS NOT ?)',
+                    [(name, kind, region_id, state, name, kind, region_id) for state, name, kind, region_id in rows])
+
+    cur.execute('SELECT state, state_id FROM States')
+    state_ids = dict(cur.fetchall())
+    members = set((region_ids[NATION], state_ids[area['state']]) for area in areas)
+    members |= set((region_ids[area['region']], state_ids[area['state']]) for area in areas if area['region'])
+    cur.execute('SELECT region_id, state_id FROM RegionMembers')
+    if set(cur.fetchall()) != members:
+        cur.execute('DELETE FROM RegionMembers')
+        cur.executemany('INSERT INTO RegionMembers (region_id, state_id) VALUES (?, ?)', sorted(members))
+        cur.execute('DELETE FROM Rollups')
+        cur.execute('DELETE FROM RegionPopulation')
+    conn.commit()
+
+def unique_keys(cur, conn):
+    '''Takes in the cur and conn variables. Adds the unique indexes the CovidData and PercentChange
+    upserts rely on: (state_id, date_id) and state_id. Databases filled by the old scripts may hold
+    duplicates, so only the newest row of every key is kept before an index is built. Returns nothing.'''
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    indexes = [row[0] for row in cur.fetchall()]
+
+    if 'CovidData_state_date_key' not in indexes:
+        cur.execute('DELETE FROM CovidData WHERE id NOT IN (SELECT MAX(id) FROM CovidData GROUP BY state_id, date_id)')
+        cur.execute('DROP INDEX IF EXISTS CovidData_state_date')
+        cur.execute('CREATE UNIQUE INDEX CovidData_state_date_key ON CovidData (state_id, date_id)')
+
+    #PercentChange used to get a new row for every state on every run
+    if 'PercentChange_state_key' not in indexes:
+        cur.execute('DELETE FROM PercentChange WHERE rowid NOT IN (SELECT MAX(rowid) FROM PercentChange GROUP BY state_id)')
+        cur.execute('CREATE UNIQUE INDEX PercentChange_state_key ON PercentChange (state_id)')
+
+#a state whose CovidData ('cases') or Population ('population') rows change is marked in DirtyStates,
+#so derived_metrics.refresh() only recomputes the metrics of that state that depend on them
+DIRTY_TRIGGERS = [
+    ('CovidData', 'cases', 'INSERT', 'NEW'),
+    ('CovidData', 'cases', 'UPDATE', 'NEW'),
+    ('CovidData', 'cases', 'DELETE', 'OLD'),
+    ('Population', 'population', 'INSERT', 'NEW'),
+    ('Population', 'population', 'UPDATE', 'NEW'),
+    ('Population', 'population', 'DELETE', 'OLD'),
+]
+
+#a date_id whose CovidMetrics rows change ('date') or a year whose Population rows change ('year') is
+#marked in DirtyRollups, so rollups.refresh() only sums those again
+ROLLUP_TRIGGERS = [
+    ('CovidMetrics', 'date', 'date_id', 'INSERT', 'NEW'),
+    ('CovidMetrics', 'date', 'date_id', 'UPDATE', 'NEW'),
+    ('CovidMetrics', 'date', 'date_id', 'DELETE', 'OLD'),
+    ('Population', 'year', 'year', 'INSERT', 'NEW'),
+    ('Population', 'year', 'year', 'UPDATE', 'NEW'),
+    ('Population', 'year', 'year', 'DELETE', 'OLD'),
+]
+
+def rollup_tables(cur, conn):
+    '''Takes in the cur and conn variables. Creates the region hierarchy (Regions, and RegionMembers
+    linking every region to all the areas under it), the rollup tables holding the sums of every region
+    (Rollups for CovidMetrics by date, RegionPopulation by year), RegionMetrics for the rates and
+    percent changes computed from them, and DirtyRollups (see dirty_triggers). Returns nothing.'''
+    cur.execute('''CREATE TABLE IF NOT EXISTS Regions ("region_id" INTEGER PRIMARY KEY, "name" TEXT UNIQUE, "level" TEXT,
+        "parent_id" INTEGER REFERENCES Regions (region_id))''')
+    cur.execute('CREATE TABLE IF NOT EXISTS RegionMembers ("region_id" INTEGER, "state_id" INTEGER, PRIMARY KEY (region_id, state_id)) WITHOUT ROWID')
+    cur.execute('''CREATE TABLE IF NOT EXISTS Rollups ("region_id" INTEGER, "metric_id" INTEGER, "date_id" INTEGER, "value" INTEGER,
+        "areas" INTEGER, PRIMARY KEY (region_id, metric_id, date_id)) WITHOUT ROWID''')
+    cur.execute('CREATE INDEX IF NOT EXISTS Rollups_date ON Rollups (date_id)')
+    cur.execute('''CREATE TABLE IF NOT EXISTS RegionPopulation ("region_id" INTEGER, "year" INTEGER, "population" INTEGER,
+        "areas" INTEGER, PRIMARY KEY (region_id, year)) WITHOUT ROWID''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS RegionMetrics ("region_id" INTEGER, "metric" TEXT, "period" TEXT, "value" REAL,
+        PRIMARY KEY (region_id, metric, period)) WITHOUT ROWID''')
+    cur.execute('CREATE TABLE IF NOT EXISTS DirtyRollups ("kind" TEXT, "key" INTEGER, PRIMARY KEY (kind, key)) WITHOUT ROWID')
+
+def metrics_tables(cur, conn):
+    '''Takes in the cur and conn variables. Creates DerivedMetrics, which holds one precomputed value per
+    (state_id, metric, period), the index top-N reads are answered from, the DirtyStates table that
+    dirty_triggers() fills and MetricWindows, the windows besides the default ones kept up to date (see
+    derived_metrics.add_window). Returns nothing.'''
+    cur.execute('''CREATE TABLE IF NOT EXISTS DerivedMetrics ("state_id" INTEGER REFERENCES States (state_id),
+        "metric" TEXT, "period" TEXT, "value" REAL, PRIMARY KEY (state_id, metric, period))''')
+    cur.execute('CREATE INDEX IF NOT EXISTS DerivedMetrics_top ON DerivedMetrics (metric, period, value)')
+    cur.execute('CREATE TABLE IF NOT EXISTS DirtyStates ("state_id" INTEGER, "source" TEXT, PRIMARY KEY (state_id, source))')
+    cur.execute('CREATE TABLE IF NOT EXISTS MetricWindows ("metric" TEXT, "period" TEXT, PRIMARY KEY (metric, period))')
+
+def dirty_triggers(cur, conn):
+    '''Takes in the cur and conn variables. Creates the triggers that fill DirtyStates and DirtyRollups.
+    Run after every migration, since a table that is rebuilt loses its triggers. The triggers are
+    created again every time so older databases get the current bodies. Returns nothing.'''
+    #an upsert's conflict handling overrides INSERT OR IGNORE inside the triggers it fires, so a row
+    #already marked has to be skipped with NOT EXISTS
+    for table, source, event, row in DIRTY_TRIGGERS:
+        cur.execute(f'DROP TRIGGER IF EXISTS {table}_dirty_{event.lower()}')
+        cur.execute(f'''CREATE TRIGGER {table}_dirty_{event.lower()} AFTER {event} ON {table}
+            BEGIN INSERT INTO DirtyStates (state_id, source) SELECT {row}.state_id, '{source}'
+                WHERE NOT EXISTS (SELECT 1 FROM DirtyStates WHERE state_id = {row}.state_id AND source = '{source}'); END''')
+    for table, kind, column, event, row in ROLLUP_TRIGGERS:
+        cur.execute(f'DROP TRIGGER IF EXISTS {table}_rollup_{event.lower()}')
+        cur.execute(f'''CREATE TRIGGER {table}_rollup_{event.lower()} AFTER {event} ON {table}
+            BEGIN INSERT INTO DirtyRollups (kind, key) SELECT '{kind}', {row}.{column}
+                WHERE NOT EXISTS (SELECT 1 FROM DirtyRollups WHERE kind = '{kind}' AND key = {row}.{column}); END''')
+
+def migrate_population(cur, conn):
+    '''Takes in the cur and conn variables. Converts a Population table in the old layout (a
+    "Texas:2020" state string and a comma formatted population) to the normalized one: a state_id
+    pointing at States, an integer year and an integer population, unique on (state_id, year).
+    Does nothing if the table is already normalized. Returns nothing.'''
+    cur.execute('PRAGMA table_info(Population)')
+    if 'year' in [row[1] for row in cur.fetchall()]:
+        return
+
+    cur.execute('SELECT name, state_id FROM States')
+    state_ids = dict(cur.fetchall())
+    cur.execute('SELECT state, population FROM Population ORDER BY id')
+    rows = {}
+    for state, population in cur.fetchall():
+        name, year = state.split(":")
+        if name in state_ids:
+            rows[(state_ids[name], int(year))] = int(str(population).replace(',', ''))
+
+    cur.execute('DROP TABLE Population')
+    cur.execute(POPULATION_SCHEMA)
+    cur.executemany('INSERT INTO Population (state_id, year, population) VALUES (?, ?, ?)',
+                    [(state_id, year, population) for (state_id, year), population in rows.items()])
+
+def evict_lru(conn, table, key, max_bytes):
+    '''Takes in a connection, a cache table with a key column and a size and last_used column for every
+    entry, the name of the key column and the most bytes to keep. Deletes the least recently used entries
+    until the sizes add up to at most max_bytes. Doesn't commit; returns nothing.'''
+    total = conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM {table}').fetchone()[0]
+    if total <= max_bytes:
+        return
+    for value, size in conn.execute(f'SELECT {key}, size FROM {table} ORDER BY last_used').fetchall():
+        conn.execute(f'DELETE FROM {table} WHERE {key} = ?', (value,))
+        total -= size
+        if total <= max_bytes:
+            break
+
+class BatchWriter:
+    '''Buffers rows for one INSERT statement and writes them with executemany, batch_size rows at a
+    time. Nothing is committed until close(), so all the batches go in as a single transaction. Used
+    as a context manager it commits on success and rolls everything back if an error is raised.
+    written counts the rows sent and changed the rows actually inserted or updated.'''
+
+    def __init__(self, cur, conn, sql, batch_size=1000):
+        self.cur = cur
+        self.conn = conn
+        self.sql = sql
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+        self.changed = 0
+
+    def add(self, row):
+        '''Takes in a tuple of values for the statement. Flushes when the buffer is full.'''
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        '''Takes in an iterable of row tuples and adds each of them.'''
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        '''Writes the buffered rows with executemany without committing.'''
+        if self.rows:
+            self.cur.executemany(self.sql, self.rows)
+            self.written += len(self.rows)
+            #rowcount leaves out rows changed by triggers and upserts that changed nothing
+            changed = max(self.cur.rowcount, 0)
+            self.changed += changed
+            instrument.count('rows_written', changed)
+            self.rows = []
+
+    def close(self):
+        '''Flushes the remaining rows and commits the transaction. Returns the number of rows written.'''
+        self.flush()
+        self.conn.commit()
+        return self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.rows = []
+            self.conn.rollback()
+        return False
+
+class ConnectionPool:
+    '''A fixed number of connections to one database shared by threads, e.g. the stages of a pipeline
+    run. Connections are opened on first use, at most size of them, and handed out one thread at a time
+    by connection(); a thread asking when all are busy waits for one to come back. With read_only every
+    connection is opened read-only, so readers can never take the write lock.'''
+
+    def __init__(self, db_name, size=4, journal_mode='WAL', synchronous='NORMAL', timeout=30.0, read_only=False):
+        self.db_name = db_name
+        self.read_only = read_only
+        self.size = size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        '''Context manager that lends out a (cur, conn) pair. Anything left uncommitted is rolled back
+        when it is given back.'''
+        pair = None
+        with self.lock:
+            if self.idle.empty() and len(self.opened) < self.size:
+                pair = setUpDatabase(self.db_name, self.journal_mode, self.synchronous, self.timeout, check_same_thread=False, read_only=self.read_only)
+                self.opened.append(pair)
+        cur, conn = pair if pair is not None else self.idle.get()
+        try:
+            yield cur, conn
+        finally:
+            conn.rollback()
+            self.idle.put((cur, conn))
+
+    def close(self):
+        '''Closes every connection the pool opened.'''
+        with self.lock:
+            for cur, conn in self.opened:
+                conn.close()
+            self.opened = []
+            self.idle = queue.LifoQueue()
@@ -0,0 +1,85 @@
+import instrument
+
+#
+# Materialized per-state metrics. DerivedMetrics holds one value per (state, metric, period) and is
+# refreshed incrementally: triggers on CovidData and Population mark changed states in DirtyStates,
+# and refresh() only recomputes those states plus any (metric, period) never computed before.
+#
+
+#the source tables ('cases' is CovidData, 'population' is Population) each metric is computed from
+SOURCES = {
+    'percent_change': ('cases',),
+    'cases_per_capita': ('cases', 'population'),
+    'population_growth': ('population',),
+}
+
+#value of every metric for each state, from the period's parameters; NULL where it can't be computed
+VALUES = {
+    #percent change in cases from the first date to the second
+    'percent_change': '''(end_cases.number_of_cases - start_cases.number_of_cases) * 100.0 / NULLIF(start_cases.number_of_cases, 0)
+        FROM States
+        LEFT JOIN CovidData AS start_cases ON start_cases.state_id = States.state_id AND start_cases.date_id = (SELECT date_id FROM Dates WHERE date = ?)
+        LEFT JOIN CovidData AS end_cases ON end_cases.state_id = States.state_id AND end_cases.date_id = (SELECT date_id FROM Dates WHERE date = ?)''',
+    #cases on a date over the population of a year
+    'cases_per_capita': '''CAST(cases.number_of_cases AS REAL) / NULLIF(pop.population, 0)
+        FROM States
+        LEFT JOIN CovidData AS cases ON cases.state_id = States.state_id AND cases.date_id = (SELECT date_id FROM Dates WHERE date = ?)
+        LEFT JOIN Population AS pop ON pop.state_id = States.state_id AND pop.year = ?''',
+    #population of the second year over the first
+    'population_growth': '''CAST(pop.population AS REAL) / NULLIF(base.population, 0)
+        FROM States
+        LEFT JOIN Population AS base ON base.state_id = States.state_id AND base.year = ?
+        LEFT JOIN Population AS pop ON pop.state_id = States.state_id AND pop.year = ?''',
+}
+
+#what the project reports: Dec 1st 2020 to Mar 7th 2021 and the 2010 and 2020 censuses
+DEFAULT_WINDOWS = [
+    ('percent_change', (20201201, 20210307)),
+    ('cases_per_capita', (20201201, 2020)),
+    ('population_growth', (2010, 2020)),
+]
+
+def window(*params):
+    '''Takes in the parameters of a metric (dates and years). Returns the period key they are stored
+    under, e.g. window(20201201, 20210307) is "20201201-20210307".'''
+    return '-'.join(str(param) for param in params)
+
+def add_window(cur, conn, metric, params):
+    '''Takes in the cursor and connection variables, a metric of VALUES and its parameters. Stores the
+    window in MetricWindows (without committing), so every later refresh() keeps it up to date along with
+    the windows it is given. Returns the period key.'''
+    period = window(*params)
+    cur.execute('INSERT OR IGNORE INTO MetricWindows (metric, period) VALUES (?, ?)', (metric, period))
+    return period
+
+def stored_windows(cur, conn):
+    '''Takes in the cursor and connection variables. Returns the (metric, params) tuples add_window() stored.'''
+    cur.execute('SELECT metric, period FROM MetricWindows ORDER BY metric, period')
+    return [(metric, tuple(int(param) for param in period.split('-'))) for metric, period in cur.fetchall()]
+
+@instrument.timed('refresh_metrics')
+def refresh(cur, conn, windows=DEFAULT_WINDOWS):
+    '''Takes in the cursor and connection variables and a list of (metric, params) tuples, params being the
+    dates and years the metric's query in VALUES takes (see DEFAULT_WINDOWS); the windows stored with
+    add_window() are refreshed as well. First drops the stored metrics of every state marked dirty that depend
+    on the changed table, then computes, in one INSERT ... SELECT per window, the value of every state that
+    has no row for that window yet. Commits and returns the number of values computed; 0 when nothing changed
+    since the last refresh.'''
+    for metric, sources in SOURCES.items():
+        placeholders = ', '.join('?' * len(sources))
+        cur.execute(f'DELETE FROM DerivedMetrics WHERE metric = ? AND state_id IN (SELECT state_id FROM DirtyStates WHERE source IN ({placeholders}))',
+                    [metric] + list(sources))
+    cur.execute('DELETE FROM DirtyStates')
+
+    #the dirty states' rows were dropped for every period, so every stored window is computed again
+    windows = list(windows) + [stored for stored in stored_windows(cur, conn) if stored not in windows]
+    computed = 0
+    for metric, params in windows:
+        period = window(*params)
+        cur.execute(f'''INSERT INTO DerivedMetrics (state_id, metric, period, value) SELECT States.state_id, ?, ?, {VALUES[metric]}
+            WHERE NOT EXISTS (SELECT 1 FROM DerivedMetrics AS stored WHERE stored.state_id = States.state_id AND stored.metric = ? AND stored.period = ?)''',
+                    [metric, period] + list(params) + [metric, period])
+        computed += cur.rowcount
+    conn.commit()
+    instrument.count('metrics_computed', computed)
+    return computed
@@ -0,0 +1,189 @@
+import os
+import csv
+import gzip
+import argparse
+import importlib.util
+from database import setUpDatabase
+import instrument
+
+#
+# Streams tables and derived metric sets out of the project database for other tools to load: Parquet
+# or Arrow IPC files when pyarrow is installed, gzipped CSV otherwise. Rows are read with fetchmany()
+# and written chunk by chunk, so exports of any size use the memory of one chunk. Usage:
+# python export.py cases metrics [--format parquet] [--start 20210101] [--end 20210307] [--states mi,oh]
+#
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+FORMATS = ['parquet', 'arrow', 'csv']
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv.gz'}
+
+#query of every export; date and state name the columns the date and state filters apply to (None
+#when the export has no such column) and columns the output columns with their types
+SOURCES = {
+    'cases': {
+        'query': '''SELECT States.state, CAST(Dates.date AS INTEGER), CovidData.number_of_cases
+            FROM CovidData JOIN States ON CovidData.state_id = States.state_id JOIN Dates ON CovidData.date_id = Dates.date_id''',
+        'order': 'CovidData.state_id, Dates.date',
+        'date': 'Dates.date', 'state': 'States.state',
+        'columns': [('state', 'string'), ('date', 'int64'), ('cases', 'int64')],
+    },
+    'metrics': {
+        'query': '''SELECT States.state, CAST(Dates.date AS INTEGER), MetricTypes.name, CovidMetrics.value
+            FROM CovidMetrics JOIN States ON CovidMetrics.state_id = States.state_id JOIN Dates ON CovidMetrics.date_id = Dates.date_id
+            JOIN MetricTypes ON CovidMetrics.metric_id = MetricTypes.metric_id''',
+        'order': 'CovidMetrics.state_id, Dates.date, CovidMetrics.metric_id',
+        'date': 'Dates.date', 'state': 'States.state',
+        'columns': [('state', 'string'), ('date', 'int64'), ('metric', 'string'), ('value', 'int64')],
+    },
+    'population': {
+        'query': '''SELECT States.state, States.name, Population.year, Population.population
+            FROM Population JOIN States ON Population.state_id = States.state_id''',
+        'order': 'Population.state_id, Population.year',
+        'date': None, 'state': 'States.state',
+        'columns': [('state', 'string'), ('name', 'string'), ('year', 'int64'), ('population', 'int64')],
+    },
+    'derived_metrics': {
+        'query': '''SELECT States.state, DerivedMetrics.metric, DerivedMetrics.period, DerivedMetrics.value
+            FROM DerivedMetrics JOIN States ON DerivedMetrics.state_id = States.state_id''',
+        'order': 'DerivedMetrics.metric, DerivedMetrics.period, DerivedMetrics.state_id',
+        'date': None, 'state': 'States.state',
+        'columns': [('state', 'string'), ('metric', 'string'), ('period', 'string'), ('value', 'float64')],
+    },
+    'rollups': {
+        'query': '''SELECT Regions.name, CAST(Dates.date AS INTEGER), MetricTypes.name, Rollups.value, Rollups.areas
+            FROM Rollups JOIN Regions ON Rollups.region_id = Regions.region_id JOIN Dates ON Rollups.date_id = Dates.date_id
+            JOIN MetricTypes ON Rollups.metric_id = MetricTypes.metric_id''',
+        'order': 'Rollups.region_id, Dates.date, Rollups.metric_id',
+        'date': 'Dates.date', 'state': None,
+        'columns': [('region', 'string'), ('date', 'int64'), ('metric', 'string'), ('value', 'int64'), ('areas', 'int64')],
+    },
+    'region_metrics': {
+        'query': '''SELECT Regions.name, Regions.level, RegionMetrics.metric, RegionMetrics.period, RegionMetrics.value
+            FROM RegionMetrics JOIN Regions ON RegionMetrics.region_id = Regions.region_id''',
+        'order': 'RegionMetrics.metric, RegionMetrics.period, RegionMetrics.region_id',
+        'date': None, 'state': None,
+        'columns': [('region', 'string'), ('level', 'string'), ('metric', 'string'), ('period', 'string'), ('value', 'float64')],
+    },
+}
+
+def source_query(name, start_date=None, end_date=None, states=None):
+    '''Takes in the name of an export in SOURCES, optionally the first and last YYYYMMDD dates and a list
+    of lowercase state abbreviations to keep. Returns the query and its parameters. Raises ValueError
+    if a filter is given for an export without that column.'''
+    source = SOURCES[name]
+    where = []
+    params = []
+    if start_date is not None or end_date is not None:
+        if source['date'] is None:
+            raise ValueError(f"{name} has no date column to filter on")
+        where.append(f"{source['date']} >= ? AND {source['date']} <= ?")
+        params += [str(start_date or 0), str(end_date or 99999999)]
+    if states:
+        if source['state'] is None:
+            raise ValueError(f"{name} has no state column to filter on")
+        where.append(f"{source['state']} IN ({', '.join('?' * len(states))})")
+        params += [state.lower() for state in states]
+    query = source['query'] + (' WHERE ' + ' AND '.join(where) if where else '') + f" ORDER BY {source['order']}"
+    return query, params
+
+class CsvWriter:
+    '''Writes chunks of rows to a gzipped CSV file with a header row.'''
+
+    def __init__(self, path, columns):
+        self.file = gzip.open(path, 'wt', newline='', compresslevel=6)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column for column, kind in columns])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class ArrowWriter:
+    '''Writes chunks of rows to a Parquet file (one row group per chunk) or an Arrow IPC file (one
+    record batch per chunk). Needs pyarrow.'''
+
+    def __init__(self, path, columns, fmt):
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([(column, getattr(pa, kind)()) for column, kind in columns])
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        arrays = [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def export(cur, name, out_dir, fmt=None, start_date=None, end_date=None, states=None, chunk_size=65536):
+    '''Takes in the cursor, the name of an export in SOURCES, the output directory, the format (parquet,
+    arrow or csv; by default parquet when pyarrow is installed and gzipped csv otherwise), the filters of
+    source_query() and the number of rows per chunk. Asking for parquet or arrow without pyarrow falls back
+    to gzipped csv. Streams the rows into out_dir/<name><extension>, which only replaces an older export
+    once complete. Returns the path written and the number of rows.'''
+    if fmt is not None and fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {FORMATS}")
+    if not HAS_PYARROW:
+        fmt = 'csv'
+    elif fmt is None:
+        fmt = 'parquet'
+    query, params = source_query(name, start_date, end_date, states)
+    columns = SOURCES[name]['columns']
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, name + EXTENSIONS[fmt])
+
+    rows_written = 0
+    with instrument.stage(f"export:{name}"):
+        writer = CsvWriter(path + '.tmp', columns) if fmt == 'csv' else ArrowWriter(path + '.tmp', columns, fmt)
+        try:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.write(rows)
+                rows_written += len(rows)
+        except BaseException:
+            writer.close()
+            os.remove(path + '.tmp')
+            raise
+        writer.close()
+        os.replace(path + '.tmp', path)
+    instrument.count('rows_exported', rows_written)
+    return path, rows_written
+
+def main():
+    parser = argparse.ArgumentParser(description='Export tables and derived metrics to Parquet, Arrow or gzipped CSV.')
+    parser.add_argument('sources', nargs='*', metavar='source', help=f"what to export (default: all): {', '.join(SOURCES)}")
+    parser.add_argument('--db', default='finalProject.db', help='database file (default: finalProject.db next to this script)')
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports'), help='output directory')
+    parser.add_argument('--format', choices=FORMATS, help='file format (default: parquet if pyarrow is installed, else csv)')
+    parser.add_argument('--start', type=int, help='first YYYYMMDD date to export')
+    parser.add_argument('--end', type=int, help='last YYYYMMDD date to export')
+    parser.add_argument('--states', help='comma separated state abbreviations to export, e.g. mi,oh')
+    parser.add_argument('--chunk-size', type=int, default=65536, help='rows read and written at a time')
+    args = parser.parse_args()
+    unknown = [name for name in args.sources if name not in SOURCES]
+    if unknown:
+        parser.error(f"unknown source: {', '.join(unknown)}")
+    if args.format in ('parquet', 'arrow') and not HAS_PYARROW:
+        print(f"pyarrow is not installed, writing gzipped csv instead of {args.format}")
+
+    cur, conn = setUpDatabase(args.db)
+    states = args.states.split(',') if args.states else None
+    for name in args.sources or list(SOURCES):
+        #filters only apply to the exports that have the column
+        start, end = (args.start, args.end) if SOURCES[name]['date'] else (None, None)
+        path, rows = export(cur, name, args.out, args.format, start, end, states if SOURCES[name]['state'] else None, args.chunk_size)
+        print(f"{path}: {rows} rows")
+    conn.close()
+
+if __name__ == "__main__":
+    main()
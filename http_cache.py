@@ -0,0 +1,96 @@
+import sqlite3
+import os
+import time
+import zlib
+import threading
+from database import evict_lru
+import instrument
+
+#
+# Persistent HTTP response cache shared by covid_data.py and population_data.py
+#
+
+#the run-wide instrument counter each of ResponseCache.stats adds to
+RUN_COUNTERS = {'hits': 'cache_hits', 'revalidated': 'cache_revalidated', 'misses': 'cache_misses', 'bytes_downloaded': 'bytes'}
+
+class OfflineCacheMiss(Exception):
+    '''Raised in offline mode when a url has never been cached.'''
+
+class ResponseCache:
+    '''On-disk cache of GET responses keyed by url, stored zlib-compressed in a sqlite file next to the
+    scripts. Entries younger than ttl seconds are served without touching the network; older ones are
+    revalidated with If-None-Match / If-Modified-Since, so an unchanged resource costs a 304 instead of
+    the full body. When the compressed bodies add up to more than max_bytes the least recently used
+    entries are evicted. In offline mode only the cache is used. Safe to share between threads.'''
+
+    def __init__(self, filename='http_cache.db', ttl=24 * 3600, max_bytes=200 * 1024 * 1024, offline=False):
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.conn = sqlite3.connect(os.path.join(path, filename), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS Responses ("url" TEXT PRIMARY KEY, "etag" TEXT, "last_modified" TEXT, "fetched_at" REAL, "last_used" REAL, "size" INTEGER, "body" BLOB)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS Responses_last_used ON Responses (last_used)')
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'bytes_downloaded': 0}
+
+    def fetch(self, session, url, timeout=10):
+        '''Takes in a requests session, a url and a timeout in seconds. Returns a (status_code, body)
+        tuple where body is the raw response bytes. Only 200 responses are stored; a 304 answer to a
+        conditional request is returned as 200 with the cached body. Raises OfflineCacheMiss in offline
+        mode if the url is not cached.'''
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified, fetched_at, body FROM Responses WHERE url = ?', (url,)).fetchone()
+
+        now = time.time()
+        if row is not None and (self.offline or now - row[2] < self.ttl):
+            self._touch(url, now, refreshed=False)
+            self._count('hits')
+            return 200, zlib.decompress(row[3])
+        if self.offline:
+            raise OfflineCacheMiss(url)
+
+        headers = {}
+        if row is not None:
+            if row[0]:
+                headers['If-None-Match'] = row[0]
+            if row[1]:
+                headers['If-Modified-Since'] = row[1]
+
+        req = session.get(url, headers=headers, timeout=timeout)
+        instrument.count('requests')
+        self._count('bytes_downloaded', len(req.content))
+        if req.status_code == 304 and row is not None:
+            self._touch(url, now, refreshed=True)
+            self._count('revalidated')
+            return 200, zlib.decompress(row[3])
+
+        self._count('misses')
+        if req.status_code == 200:
+            self._store(url, req, now)
+        return req.status_code, req.content
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+        instrument.count(RUN_COUNTERS[key], amount)
+
+    def _touch(self, url, now, refreshed):
+        with self.lock:
+            if refreshed:
+                self.conn.execute('UPDATE Responses SET fetched_at = ?, last_used = ? WHERE url = ?', (now, now, url))
+            else:
+                self.conn.execute('UPDATE Responses SET last_used = ? WHERE url = ?', (now, url))
+            self.conn.commit()
+
+    def _store(self, url, req, now):
+        body = zlib.compress(req.content)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO Responses (url, etag, last_modified, fetched_at, last_used, size, body) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (url, req.headers.get('ETag'), req.headers.get('Last-Modified'), now, now, len(body), body))
+            evict_lru(self.conn, 'Responses', 'url', self.max_bytes)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import cProfile
+import functools
+import datetime
+import threading
+from contextlib import contextmanager
+
+#
+# Run-wide timers and counters for the ingest -> compute -> render pipeline. Stages are timed with
+# stage(), counts are bumped with count(), and write_report() saves everything as JSON. If profiling
+# is turned on, each outermost stage also runs under cProfile and its stats are saved next to it.
+#
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = {}
+
+def reset(profile_dir=None):
+    '''Starts a new run, forgetting all timings and counters. If profile_dir is given, every outermost
+    stage is profiled with cProfile and saved to profile_dir/<stage>.prof.'''
+    with _lock:
+        _state.clear()
+        _state.update({
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'start_time': time.perf_counter(),
+            'stages': {},
+            'counters': {},
+            'profiles': {},
+            'profilers': {},
+            'profile_dir': profile_dir,
+        })
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+def profile_dir():
+    '''Returns the directory profiles of this run are saved to, or None when profiling is off.'''
+    return _state.get('profile_dir')
+
+def add_time(name, seconds, calls=1):
+    '''Adds seconds (over calls calls) to the total of stage name.'''
+    with _lock:
+        stage = _state['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+
+def count(name, amount=1):
+    '''Adds amount to counter name (requests, bytes, rows_written, cache_hits...).'''
+    with _lock:
+        _state['counters'][name] = _state['counters'].get(name, 0) + amount
+
+@contextmanager
+def stage(name):
+    '''Context manager that times the block as stage name. The outermost stage of a thread is also
+    profiled when profiling is on; repeated calls of a stage add up in the same profile.'''
+    profiler = None
+    if _state.get('profile_dir') is not None and not getattr(_local, 'profiling', False):
+        with _lock:
+            profiler = _state['profilers'].setdefault(name, cProfile.Profile())
+        _local.profiling = True
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+        if profiler is not None:
+            profiler.disable()
+            _local.profiling = False
+            path = os.path.join(_state['profile_dir'], name.replace(':', '_') + '.prof')
+            profiler.dump_stats(path)
+            with _lock:
+                _state['profiles'][name] = path
+
+def timed(name):
+    '''Decorator form of stage().'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def snapshot():
+    '''Returns the current run as a JSON-ready dictionary: start time, elapsed seconds, stages with
+    their total seconds and calls, counters and the paths of any saved profiles.'''
+    with _lock:
+        return {
+            'started': _state['started'],
+            'elapsed_seconds': time.perf_counter() - _state['start_time'],
+            'stages': {name: dict(values) for name, values in _state['stages'].items()},
+            'counters': dict(_state['counters']),
+            'profiles': dict(_state['profiles']),
+        }
+
+def merge(other):
+    '''Adds the stages, counters and profiles of a snapshot taken in another process (e.g. a render
+    worker) to this run.'''
+    for name, values in other['stages'].items():
+        add_time(name, values['seconds'], values['calls'])
+    for name, amount in other['counters'].items():
+        count(name, amount)
+    with _lock:
+        _state['profiles'].update(other['profiles'])
+
+def write_report(path):
+    '''Saves snapshot() as JSON to path. Returns the snapshot.'''
+    report = snapshot()
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+reset()
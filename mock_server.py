@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from database import load_states
+
+#
+# Local stand-in for the COVID Tracking Project API and the Wikipedia population page, so the
+# pipeline can be run and benchmarked without network access. Serves recorded files when a
+# recording directory is given and synthetic data otherwise, with optional latency and failures.
+#
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+API_PATH = '/v1/states'
+POP_PATH = '/wiki/List_of_states_and_territories_of_the_United_States_by_population'
+
+def synthetic_daily(state, state_id, days, end_date, seed):
+    '''Takes in a lowercase state abbreviation, its state_id, the number of days, the last date as a
+    YYYYMMDD int and a random seed. Returns a daily.json style list of records, newest first, with
+    cumulative positive, negative, death and totalTestResults counts and a hospitalizedCurrently value
+    that, like the real API, is null for the first weeks.'''
+    rng = random.Random(seed * 1000 + state_id)
+    end = datetime.datetime.strptime(str(end_date), '%Y%m%d').date()
+    positive = negative = death = 0
+    records = []
+    for offset in range(days - 1, -1, -1):
+        day = end - datetime.timedelta(days=offset)
+        new_cases = rng.randint(0, 200 * state_id)
+        positive += new_cases
+        negative += new_cases * rng.randint(3, 12)
+        death += new_cases // rng.randint(40, 120)
+        records.append({
+            'date': int(day.strftime('%Y%m%d')),
+            'state': state.upper(),
+            'positive': positive,
+            'negative': negative,
+            'death': death,
+            'totalTestResults': positive + negative,
+            'hospitalizedCurrently': rng.randint(0, 50 * state_id) if offset < days - 30 else None,
+        })
+    records.reverse()
+    return records
+
+class MockData:
+    '''Builds and caches the bodies the mock server answers with.'''
+
+    def __init__(self, days=372, end_date=20210307, recorded_dir=None, seed=206):
+        self.days = days
+        self.end_date = end_date
+        self.recorded_dir = recorded_dir
+        self.seed = seed
+        self.state_ids = {state: state_id for state_id, (state, name) in enumerate(load_states(), 1)}
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+    def body(self, path):
+        '''Takes in a request path. Returns the response body as bytes, or None for an unknown path.'''
+        with self.lock:
+            if path not in self.bodies:
+                self.bodies[path] = self._build(path)
+            return self.bodies[path]
+
+    def _build(self, path):
+        if path == POP_PATH:
+            with open(os.path.join(PATH, 'fixtures', 'population_page.html'), 'rb') as f:
+                return f.read()
+
+        parts = path.split('/')
+        if not path.startswith(API_PATH + '/') or len(parts) != 5 or parts[4] not in ('current.json', 'daily.json'):
+            return None
+        state, name = parts[3], parts[4]
+        if self.recorded_dir is not None:
+            recorded = os.path.join(self.recorded_dir, state, name)
+            if os.path.exists(recorded):
+                with open(recorded, 'rb') as f:
+                    return f.read()
+        if state not in self.state_ids:
+            return None
+
+        daily = synthetic_daily(state, self.state_ids[state], self.days, self.end_date, self.seed)
+        return json.dumps(daily[0] if name == 'current.json' else daily).encode()
+
+def make_handler(data, latency, jitter, failure_rate, seed):
+    '''Returns a request handler class bound to a MockData and the latency (seconds, plus up to jitter
+    seconds at random) and failure rate (fraction of requests answered with 503) to simulate.'''
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            stats = self.server.stats
+            with rng_lock:
+                delay = latency + rng.random() * jitter
+                fail = rng.random() < failure_rate
+            time.sleep(delay)
+            path = self.path.split('?')[0]
+            with self.server.stats_lock:
+                stats['requests'] += 1
+
+            if fail:
+                with self.server.stats_lock:
+                    stats['failures'] += 1
+                return self.reply(503, b'injected failure')
+
+            body = data.body(path)
+            if body is None:
+                return self.reply(404, b'not found')
+
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                with self.server.stats_lock:
+                    stats['not_modified'] += 1
+                return self.reply(304, b'', etag)
+            with self.server.stats_lock:
+                stats['bytes'] += len(body)
+            content_type = 'text/html; charset=UTF-8' if path == POP_PATH else 'application/json'
+            return self.reply(200, body, etag, content_type)
+
+        def reply(self, status, body, etag=None, content_type='text/plain'):
+            self.send_response(status)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            if status != 304:
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+    return Handler
+
+def start_server(port=0, days=372, end_date=20210307, latency=0.0, jitter=0.0, failure_rate=0.0, recorded_dir=None, seed=206):
+    '''Takes in the port (0 picks a free one), the number of synthetic days and their last date, the
+    latency, jitter and failure rate to simulate, an optional directory of recorded <state>/<file>.json
+    responses and a random seed. Starts the server in a background thread and returns it; base_url
+    (to pass to covid_data as the API url) and pop_url are set on it, and stats counts requests,
+    injected failures, 304 answers and body bytes sent. Call shutdown() to stop it.'''
+    data = MockData(days, end_date, recorded_dir, seed)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(data, latency, jitter, failure_rate, seed))
+    server.daemon_threads = True
+    server.stats = {'requests': 0, 'failures': 0, 'not_modified': 0, 'bytes': 0}
+    server.stats_lock = threading.Lock()
+    host, port = server.server_address
+    server.base_url = f"http://{host}:{port}{API_PATH}"
+    server.pop_url = f"http://{host}:{port}{POP_PATH}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def record(out_dir, base_url="https://api.covidtracking.com/v1/states"):
+    '''Takes in an output directory and the API url. Saves current.json and daily.json of every state
+    under out_dir/<state>/ so they can be served later with --recorded.'''
+    import requests
+    with requests.Session() as session:
+        for state, name in load_states():
+            os.makedirs(os.path.join(out_dir, state), exist_ok=True)
+            for filename in ('current.json', 'daily.json'):
+                req = session.get(f"{base_url}/{state}/{filename}", timeout=30)
+                req.raise_for_status()
+                with open(os.path.join(out_dir, state, filename), 'wb') as f:
+                    f.write(req.content)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the COVID Tracking API and the Wikipedia population page.')
+    parser.add_argument('--port', type=int, default=8206)
+    parser.add_argument('--days', type=int, default=372, help='synthetic days per state')
+    parser.add_argument('--end-date', type=int, default=20210307, help='last synthetic date, YYYYMMDD')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds at random')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--recorded', help='directory of recorded <state>/current.json and daily.json to serve')
+    parser.add_argument('--record', metavar='DIR', help='download the live API files into DIR and exit')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record)
+        return
+
+    server = start_server(args.port, args.days, args.end_date, args.latency, args.jitter, args.failure_rate, args.recorded)
+    print(f"API:        {server.base_url}")
+    print(f"Population: {server.pop_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
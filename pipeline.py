@@ -0,0 +1,186 @@
+import os
+import hashlib
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from database import setUpDatabase, create_tables, load_states, ConnectionPool
+import instrument
+
+#
+# One command for the whole project: fetch COVID data and populations at the same time, compute the
+# calculations, then render the charts. Stages whose input tables haven't changed since their last
+# run are skipped. The stage modules (requests, bs4, pandas, matplotlib) are imported by the stage
+# that needs them, so --help and partial runs don't pay for the others.
+#
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+
+def fetch_covid(cur, conn, options):
+    '''Brings CovidData up to date with covid_data.sync(). Returns the number of rows written.'''
+    import covid_data
+    covid_data.date_table(cur, conn)
+    states = [state for state, name in load_states()]
+    return covid_data.sync(cur, conn, states, base_url=options.api_url or covid_data.API_URL, cache=options.cache)
+
+def fetch_population(cur, conn, options):
+    '''Downloads and parses the population page and upserts the 2010 and 2020 populations. Returns the
+    number of rows written.'''
+    import population_data
+    html = population_data.get_page(options.pop_url or population_data.POP_URL, options.cache)
+    pop_2020, pop_2010 = population_data.get_pops(html)
+    written = population_data.pop_table(cur, conn, pop_2010, "2010")
+    written += population_data.pop_table(cur, conn, pop_2020, "2020")
+    return written
+
+def metrics(cur, conn, options):
+    '''Recomputes the DerivedMetrics values whose CovidData or Population rows changed. Returns the number
+    of values computed.'''
+    import derived_metrics
+    return derived_metrics.refresh(cur, conn)
+
+def rollups(cur, conn, options):
+    '''Sums the changed dates and years again for the nation and the census regions. Returns the number of
+    sums written.'''
+    import rollups
+    return rollups.refresh(cur, conn)
+
+def covid_calculations(cur, conn, options):
+    '''Fills PercentChange and writes covid_calculations.csv.'''
+    import covid_data
+    covid_data.write_to_file('covid_calculations.csv', cur, conn, [state for state, name in load_states()])
+
+def pop_calculations(cur, conn, options):
+    '''Writes the population changes to pop_calculations.txt.'''
+    import population_data
+    population_data.percent_changes(cur, conn)
+
+def render(cur, conn, options):
+    '''Renders every chart to files with viz.render_all(), reusing the cached ones whose data is unchanged
+    unless --force is given. Returns the list of files written.'''
+    import viz
+    return viz.render_all(options.out, options.formats, options.processes, options.db, force=options.force)
+
+#after: stages that must finish first. inputs: tables whose contents decide whether the stage has to
+#run again (None means always run, e.g. stages reading from the network). outputs: files that must
+#exist for the stage to be skipped.
+STAGES = {
+    'fetch_covid': {'after': (), 'inputs': None, 'run': fetch_covid},
+    'fetch_population': {'after': (), 'inputs': None, 'run': fetch_population},
+    #incremental by itself (see derived_metrics), so it always runs
+    'metrics': {'after': ('fetch_covid', 'fetch_population'), 'inputs': None, 'run': metrics},
+    'rollups': {'after': ('fetch_covid', 'fetch_population'), 'inputs': None, 'run': rollups},
+    'covid_calculations': {'after': ('metrics',), 'inputs': ('DerivedMetrics',),
+                           'outputs': lambda options: [os.path.join(PATH, 'covid_calculations.csv')], 'run': covid_calculations},
+    'pop_calculations': {'after': ('metrics',), 'inputs': ('DerivedMetrics',),
+                         'outputs': lambda options: [os.path.join(PATH, 'pop_calculations.txt')], 'run': pop_calculations},
+    #the render cache skips every chart whose query results are unchanged (see viz.render_all)
+    'render': {'after': ('metrics',), 'inputs': None, 'run': render},
+}
+
+def fingerprint(cur, tables, outputs=()):
+    '''Takes in the cursor, a list of table names and a list of output files. Returns a hash of every row
+    of the tables (in rowid order) and the file names, which changes whenever any of them does.'''
+    digest = hashlib.sha1()
+    for table in tables:
+        digest.update(table.encode())
+        cur.execute(f'SELECT * FROM {table} ORDER BY rowid')
+        for row in cur:
+            digest.update(repr(row).encode())
+    for path in outputs:
+        digest.update(path.encode())
+    return digest.hexdigest()
+
+def run_stage(name, pool, options, force=False):
+    '''Takes in the name of a stage in STAGES, the ConnectionPool, the parsed options and whether to run
+    it even if its inputs are unchanged. Runs the stage on a pooled connection unless its input tables
+    and output files are the same as after its last successful run. Returns 'ran' or 'skipped'.'''
+    stage = STAGES[name]
+    with pool.connection() as (cur, conn):
+        digest = None
+        if stage['inputs'] is not None:
+            outputs = stage['outputs'](options)
+            digest = fingerprint(cur, stage['inputs'], outputs)
+            cur.execute('SELECT fingerprint FROM PipelineState WHERE stage = ?', (name,))
+            row = cur.fetchone()
+            if not force and row is not None and row[0] == digest and all(os.path.exists(path) for path in outputs):
+                instrument.count('stages_skipped')
+                return 'skipped'
+
+        #its own name, the stage functions time themselves under the plain ones (e.g. fetch_covid)
+        with instrument.stage(f"stage:{name}"):
+            stage['run'](cur, conn, options)
+
+        if digest is not None:
+            cur.execute('INSERT INTO PipelineState (stage, fingerprint, finished_at) VALUES (?, ?, ?) ON CONFLICT (stage) DO UPDATE SET fingerprint = excluded.fingerprint, finished_at = excluded.finished_at',
+                        (name, digest, datetime.datetime.now().isoformat(timespec='seconds')))
+            conn.commit()
+    #frees what the stage read
+    import queries
+    queries.clear_cache()
+    instrument.count('stages_run')
+    return 'ran'
+
+def run(names, pool, options, force=False, workers=2):
+    '''Takes in the names of the stages to run, the ConnectionPool, the parsed options, whether to ignore
+    fingerprints and the number of stages allowed to run at once. Starts every stage as soon as the stages
+    it comes after have finished (stages not in names count as finished), so independent stages run at
+    the same time. Returns a dictionary with stage name as key and 'ran' or 'skipped' as value.'''
+    pending = [name for name in STAGES if name in names]
+    running = {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                if all(dep in results or dep not in names for dep in STAGES[name]['after']):
+                    pending.remove(name)
+                    running[executor.submit(run_stage, name, pool, options, force)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                print(f"{name}: {results[name]}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch, compute and render the whole project in one run.')
+    parser.add_argument('stages', nargs='*', metavar='stage', help=f"stages to run (default: all): {', '.join(STAGES)}")
+    parser.add_argument('--force', action='store_true', help='run stages even if their inputs are unchanged')
+    parser.add_argument('--offline', action='store_true', help='answer every request from the response cache')
+    parser.add_argument('--db', default='finalProject.db', help='database file (default: finalProject.db next to this script)')
+    parser.add_argument('--api-url', help='base url of the COVID Tracking API, e.g. a mock_server.py')
+    parser.add_argument('--pop-url', help='url of the population page')
+    parser.add_argument('--out', default=os.path.join(PATH, 'charts'), help='chart output directory')
+    parser.add_argument('--formats', default='png', help='comma separated chart formats, e.g. png,svg')
+    parser.add_argument('--processes', type=int, help='chart rendering processes (default: one per CPU)')
+    parser.add_argument('--workers', type=int, default=2, help='stages run at the same time')
+    parser.add_argument('--report', metavar='PATH', help='save stage timings and counters as JSON to PATH')
+    parser.add_argument('--profile', metavar='DIR', help='save a cProfile dump of every stage to DIR')
+    options = parser.parse_args()
+    unknown = [name for name in options.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage: {', '.join(unknown)}")
+    options.formats = options.formats.split(',')
+    names = options.stages or list(STAGES)
+
+    instrument.reset(options.profile)
+    cur, conn = setUpDatabase(options.db)
+    create_tables(cur, conn)
+    conn.close()
+
+    options.cache = None
+    if 'fetch_covid' in names or 'fetch_population' in names:
+        from http_cache import ResponseCache
+        options.cache = ResponseCache(offline=options.offline)
+    pool = ConnectionPool(options.db, size=options.workers)
+    try:
+        run(names, pool, options, options.force, options.workers)
+    finally:
+        pool.close()
+        if options.cache is not None:
+            options.cache.close()
+
+    if options.report is not None:
+        instrument.write_report(options.report)
+
+if __name__ == "__main__":
+    main()
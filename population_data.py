@@ -1,9 +1,16 @@
 import requests
-import sqlite3
-import json
 import os 
-from bs4 import BeautifulSoup
-import matplotlib.pyplot as plt 
+import re
+import argparse
+import importlib.util
+from database import setUpDatabase, create_tables, BatchWriter
+from http_cache import ResponseCache
+import queries
+import derived_metrics
+import instrument
+
+#bs4 (and lxml) are only imported once a page is parsed; lxml is used when installed
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
 
 #
 # Name: Mingxuan Sun
@@ -11,145 +18,133 @@ import matplotlib.pyplot as plt
 #
 
 
-def setUpDatabase(db_name):
-    '''This function takes in the name of the database, makes a connection to server
-    using nane given, and returns cur and conn as the cursor and connection variable
-    to allow database access.'''
-    
-    path = os.path.dirname(os.path.abspath(__file__))
-    conn = sqlite3.connect(path+'/'+db_name)
-    cur = conn.cursor()
-    return cur, conn
-
-def pop_table(cur, conn, pop_dict, date, count): 
-    '''This function takes in the cursor and connection variables to database, state, year and number of US Population for that state. It creates a table in the database if it doesn’t exist and inserts the state, date and number of population. Returns nothing'''
-    
-    cur.execute('CREATE TABLE IF NOT EXISTS Population ("id" INTEGER PRIMARY KEY, "state" TEXT, "population" INTEGER)')
-
-    # Inserting 50 states at a time into Population Database
-    for x in pop_dict:
-       
-        cur.execute('INSERT INTO Population (id, state, population) VALUES (?, ?, ?)', (count, x + ":" + str(date), pop_dict[x]))
-        count += 1
-       
-    conn.commit()
-
-def percent_changes(cur, conn):
-    '''This function takes in cursor and connection variables. It grabs the population and states from the database, seeds out the 2020 and 2010 population, append the state name into a labels list and its population numbers to the population list. Calculate percentage changes and write the calculations onto a txt file. Returns nothing.'''
-
-    labels2020 = []
-    pop2020 = []
-
-    # Grabbing Populations and States from the Database
-    cursor = cur.execute("SELECT state, population FROM Population")
-    for row in cursor:
-        if row[0].split(":")[1] == "2020":
-            labels2020.append(row[0].split(":")[0])
-            num = row[1]
-            num = int(num.replace(',', ''))
-            pop2020.append(num)
-
-    labels2010 = []
-    pop2010 = []
-
-    cursor = cur.execute("SELECT state, population FROM Population")
-    for row in cursor:
-        if row[0].split(":")[1] == "2010":
-            labels2010.append(row[0].split(":")[0])
-            num = row[1]
-            num = int(num.replace(',', ''))
-            pop2010.append(num)
-
-    f = open("pop_calculations.txt", "w+")
-    for x in range(len(labels2010)):
-
-        f.write(labels2010[x] + " has had a " + str(pop2020[x]/pop2010[x]) + " change in population\n")
+#upsert: a (state_id, year) that is already stored is only rewritten if its population changed
+POP_INSERT = '''INSERT INTO Population (state_id, year, population) VALUES (?, ?, ?)
+    ON CONFLICT (state_id, year) DO UPDATE SET population = excluded.population
+    WHERE population IS NOT excluded.population'''
 
-    f.close()
+@instrument.timed('write_population')
+def pop_table(cur, conn, pop_dict, date): 
+    '''This function takes in the cursor and connection variables to database, a dictionary of state name to US Population for that state (as scraped, with commas) and the year. It parses the populations to integers once and upserts the state_id, year and population with executemany in a single transaction (the tables must already exist, see create_tables), so running it again writes nothing new. Names not in States are skipped. Returns the number of rows written.'''
 
-def pop_table_length(cur, conn):
-    '''This function calculates the number of rows in the CovidData table to help with extracting
-    25 lines at a time. Returns the number of rows in the table as an int.'''
-    cur.execute('CREATE TABLE IF NOT EXISTS Population ("id" INTEGER PRIMARY KEY, "state" TEXT, "population" INTEGER)')
-    cur.execute('SELECT MAX(id) FROM Population')
-    data = cur.fetchone()
-    num = data[0]
-    return num
+    cur.execute('SELECT name, state_id FROM States')
+    state_ids = dict(cur.fetchall())
 
-############################################################
+    with BatchWriter(cur, conn, POP_INSERT) as writer:
+        for x in pop_dict:
+            if x in state_ids:
+                writer.add((state_ids[x], int(date), int(pop_dict[x].replace(',', ''))))
+    return writer.changed
 
- 
-def get_pop_2020(soup): 
-    '''This function takes in a soup request called in the main() and finds the table retaining population numbers through class tag. Then it finds the rows of the table and iterates through the rows to scrape state names and population numbers. It appends the state and population number into a dictionary where state is key and population number is value. It removes District of Columbia to get 50 states. Returns dictionary containing state name and 2020 population numbers.'''
+@instrument.timed('write_population_txt')
+def percent_changes(cur, conn, metrics=None):
+    '''This function takes in cursor and connection variables and optionally a frame from analytics.state_metrics, whose population_growth column is the 2020 over 2010 population of every state (by default the precomputed values in DerivedMetrics are read after an incremental refresh). It writes the changes onto pop_calculations.txt next to this script. Returns nothing.'''
 
-    table = soup.find('table',{'class':'wikitable sortable'})
-    body = table.find('tbody')
-    all_rows = body.find_all('tr')
-
-    key_pop_2020_dict = {}
-
-    for row in all_rows[2:53]: 
-        row_cells = row.find_all('td')
-        key = row_cells[2].text.strip()
-        value = row_cells[3].text.strip()
-        key_pop_2020_dict[key] = value
+    if metrics is None:
+        derived_metrics.refresh(cur, conn)
+        stored = queries.metric_values(cur, 'population_growth', derived_metrics.window(2010, 2020))
+        growth = [(name, change) for state, name, change in stored if change is not None]
+    else:
+        growth = metrics[metrics['population_growth'].notna()]
+        growth = zip(growth['name'], growth['population_growth'])
 
-    key_pop_2020_dict.pop('District of Columbia')
+    path = os.path.dirname(os.path.abspath(__file__)) + os.sep
+    f = open(path + "pop_calculations.txt", "w+")
+    for name, change in growth:
 
-    return key_pop_2020_dict
+        f.write(name + " has had a " + str(change) + " change in population\n")
 
-def get_pop_2010(soup): 
-    '''This function takes in a soup request called in the main() and finds the table retaining population numbers through class tag. Then it finds the rows of the table and iterates through the rows to scrape state names and population numbers. It appends the state and population number into a dictionary where state is key and population number is value. It removes District of Columbia to get 50 states. Returns dictionary containing state name and 2010 population numbers.'''
+    f.close()
 
+############################################################
 
-    table = soup.find('table',{'class':'wikitable sortable'})
-    body = table.find('tbody')
-    all_rows = body.find_all('tr')
+ 
+# same table soup.find('table', {'class': 'wikitable sortable'}) picks: class is exactly "wikitable sortable"
+POP_TABLE_TAG = re.compile(r'<table\b[^>]*\bclass="wikitable sortable"[^>]*>')
+TABLE_TAGS = re.compile(r'<(/?)table\b', re.IGNORECASE)
+
+def get_pop_table(html):
+    '''This function takes in the html of the Wikipedia page. It finds the population table with a plain string search instead of parsing the whole page, and follows nested table tags to its closing tag. Returns the markup of just that table, or None if the page has no such table.'''
+    match = POP_TABLE_TAG.search(html)
+    if match is None:
+        return None
+
+    depth = 1
+    for tag in TABLE_TAGS.finditer(html, match.end()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return html[match.start():html.index('>', tag.end()) + 1]
+    return html[match.start():]
+
+@instrument.timed('parse_population')
+def get_pops(html): 
+    '''This function takes in the html of the Wikipedia page called in the main(). It parses only the rows of the population table (lxml is used when installed) and walks them once, scraping the state name with both its 2020 and 2010 population numbers. Every row is kept, so DC and the territories are scraped along with the states. Returns two dictionaries with state name as key, the first with 2020 and the second with 2010 population numbers as value.'''
+
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    table = get_pop_table(html)
+    if table is None:
+        raise ValueError("population table not found on page")
+    all_rows = BeautifulSoup(table, HTML_PARSER, parse_only=SoupStrainer('tr')).find_all('tr')
 
+    key_pop_2020_dict = {}
     key_pop_2010_dict = {}
 
-    for row in all_rows[2:53]: 
+    for row in all_rows[2:]: 
         row_cells = row.find_all('td')
+        if len(row_cells) < 5:
+            continue
         key = row_cells[2].text.strip()
-        value = row_cells[4].text.strip()
-        key_pop_2010_dict[key] = value
-    
-    key_pop_2010_dict.pop('District of Columbia')
-
-    return key_pop_2010_dict
-
-
-def main(): 
-    soup = BeautifulSoup(requests.get('https://en.wikipedia.org/wiki/List_of_states_and_territories_of_the_United_States_by_population').text, 'html.parser')
+        key_pop_2020_dict[key] = row_cells[3].text.strip()
+        key_pop_2010_dict[key] = row_cells[4].text.strip()
+
+    return key_pop_2020_dict, key_pop_2010_dict
+
+
+POP_URL = 'https://en.wikipedia.org/wiki/List_of_states_and_territories_of_the_United_States_by_population'
+
+@instrument.timed('fetch_population')
+def get_page(url, cache=None):
+    '''This function takes in a url and optionally a ResponseCache. It downloads the page (through the cache if one is given, so repeat runs only send a conditional request) and returns its html as text.'''
+    if cache is None:
+        req = requests.get(url)
+        instrument.count('requests')
+        instrument.count('bytes', len(req.content))
+        req.raise_for_status()
+        return req.text
+
+    with requests.Session() as session:
+        status, body = cache.fetch(session, url)
+    if status != 200:
+        raise requests.HTTPError(f"{status} error for url: {url}")
+    return body.decode('utf-8')
+
+def main(offline=False, report=None, profile_dir=None): 
+    instrument.reset(profile_dir)
+    cache = ResponseCache(offline=offline)
+    html = get_page(POP_URL, cache)
+    cache.close()
     
-    pop_2020 = get_pop_2020(soup)
-    pop_2020_firsthalf = dict(list(pop_2020.items())[:25])
-    pop_2020_secondhalf = dict(list(pop_2020.items())[25:])
-
-    pop_2010 = get_pop_2010(soup)
-    pop_2010_firsthalf = dict(list(pop_2010.items())[:25])
-    pop_2010_secondhalf = dict(list(pop_2010.items())[25:])
+    pop_2020, pop_2010 = get_pops(html)
 
     cur, conn = setUpDatabase("finalProject.db")
+    create_tables(cur, conn)
 
-    num = pop_table_length(cur, conn)
-
-    if num == None:
-        pop_table(cur, conn, pop_2010_firsthalf, "2010", 1)
-        return
-    elif type(num) == int:
-        if num <= 25:
-            pop_table(cur, conn, pop_2010_secondhalf, "2010", 26)
-            return
-        if num <= 50:
-            pop_table(cur, conn, pop_2020_firsthalf, "2020", 51)
-            return
-        if num <= 75:
-            pop_table(cur, conn, pop_2020_secondhalf, "2020", 76)
+    written = pop_table(cur, conn, pop_2010, "2010")
+    written += pop_table(cur, conn, pop_2020, "2020")
+    print(f"{written} rows written")
 
     percent_changes(cur, conn)
+
+    if report is not None:
+        instrument.write_report(report)
     
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Scrape the 2010 and 2020 state populations into the Population table.')
+    parser.add_argument('--offline', action='store_true', help='answer the request from the response cache')
+    parser.add_argument('--report', metavar='PATH', help='save stage timings and counters as JSON to PATH')
+    parser.add_argument('--profile', metavar='DIR', help='save a cProfile dump of every stage to DIR')
+    args = parser.parse_args()
+    main(args.offline, args.report, args.profile)
       
\ No newline at end of file
@@ -0,0 +1,177 @@
+import functools
+import inspect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import pandas as pd
+import instrument
+
+#
+# Read side shared by viz.py and analytics.py. Every query is parameterized and answered from an
+# index, and results are memoized so all the charts of a run share one read of each table until
+# the database changes.
+#
+
+#connection id -> the connection, its version and its results, least recently used first. Keeping the
+#connection in its entry means its id can't be reused by another connection while the entry exists.
+_connections = OrderedDict()
+_lock = threading.Lock()
+MAX_CONNECTIONS = 8
+MAX_RESULTS = 64
+#lists collecting the calls made inside recording() blocks
+_recordings = []
+
+def memoized(func):
+    '''Caches the result of a query function by connection and arguments (defaults filled in). The results
+    of a connection are dropped when its PRAGMA data_version (which changes when any other connection or
+    process commits) or its total_changes (its own writes) moved. At most MAX_RESULTS results of the
+    MAX_CONNECTIONS most recently used connections are kept. Results are shared between callers and must
+    not be modified.'''
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(cur, *args, **kwargs):
+        bound = signature.bind(cur, *args, **kwargs)
+        bound.apply_defaults()
+        params = tuple(tuple(value) if isinstance(value, list) else value for value in list(bound.arguments.values())[1:])
+        conn = cur.connection
+        version = (conn.execute('PRAGMA data_version').fetchone()[0], conn.total_changes)
+        key = (func.__name__, params)
+        with _lock:
+            entry = _connections.get(id(conn))
+            if entry is None or entry['version'] != version:
+                entry = {'conn': conn, 'version': version, 'results': OrderedDict()}
+                _connections[id(conn)] = entry
+            _connections.move_to_end(id(conn))
+            while len(_connections) > MAX_CONNECTIONS:
+                _connections.popitem(last=False)
+            found = key in entry['results']
+            if found:
+                entry['results'].move_to_end(key)
+                result = entry['results'][key]
+
+        if found:
+            instrument.count('query_hits')
+        else:
+            instrument.count('query_misses')
+            result = func(cur, *params)
+            with _lock:
+                entry['results'][key] = result
+                while len(entry['results']) > MAX_RESULTS:
+                    entry['results'].popitem(last=False)
+        for calls in _recordings:
+            if not any(call[:2] == key for call in calls):
+                calls.append(key + (result,))
+        return result
+    return wrapper
+
+@contextmanager
+def recording():
+    '''Context manager that yields a list of the (query name, arguments, result) of every query called
+    inside the block, in order and without repeats, e.g. to know which results a chart was drawn from.'''
+    calls = []
+    _recordings.append(calls)
+    try:
+        yield calls
+    finally:
+        _recordings.remove(calls)
+
+def clear_cache():
+    '''Forgets every memoized result, e.g. to free memory at the end of a pipeline stage.'''
+    with _lock:
+        _connections.clear()
+
+@memoized
+def cases_frame(cur):
+    '''Takes in the cursor. Reads CovidData joined with States and Dates in one query. Returns a frame
+    with state_id, state, date (YYYYMMDD int) and cases columns.'''
+    return pd.read_sql_query('SELECT CovidData.state_id, States.state, CAST(Dates.date AS INTEGER) AS date, CovidData.number_of_cases AS cases FROM CovidData JOIN States ON CovidData.state_id = States.state_id JOIN Dates ON CovidData.date_id = Dates.date_id ORDER BY CovidData.state_id, Dates.date', cur.connection)
+
+@memoized
+def population_frame(cur):
+    '''Takes in the cursor. Reads Population joined with States in one query. Returns a frame with
+    state_id, state, name, year and population columns.'''
+    return pd.read_sql_query('SELECT Population.state_id, States.state, States.name, Population.year, Population.population FROM Population JOIN States ON Population.state_id = States.state_id ORDER BY Population.state_id, Population.year', cur.connection)
+
+@memoized
+def top_cases(cur, date, n=10):
+    '''Takes in the cursor, a YYYYMMDD date and how many states to return. Returns a list of
+    (state, cases) tuples for the n states with the most cases on that date, highest first.'''
+    cur.execute('SELECT States.state, CovidData.number_of_cases FROM Dates JOIN CovidData ON CovidData.date_id = Dates.date_id JOIN States ON CovidData.state_id = States.state_id WHERE Dates.date = ? ORDER BY CovidData.number_of_cases DESC LIMIT ?', (str(date), n))
+    return cur.fetchall()
+
+@memoized
+def cases_for_states(cur, states, date):
+    '''Takes in the cursor, a list of lowercase state abbreviations and a YYYYMMDD date. Returns a list
+    of (state, cases) tuples for the given states on that date.'''
+    placeholders = ', '.join('?' * len(states))
+    cur.execute(f'SELECT States.state, CovidData.number_of_cases FROM Dates JOIN CovidData ON CovidData.date_id = Dates.date_id JOIN States ON CovidData.state_id = States.state_id WHERE Dates.date = ? AND States.state IN ({placeholders})', [str(date)] + list(states))
+    return cur.fetchall()
+
+@memoized
+def population_by_year(cur, year):
+    '''Takes in the cursor and a census year. Returns a list of (state, name, population) tuples for
+    that year, biggest population first.'''
+    cur.execute('SELECT States.state, States.name, Population.population FROM Population JOIN States ON Population.state_id = States.state_id WHERE Population.year = ? ORDER BY Population.population DESC', (year,))
+    return cur.fetchall()
+
+@memoized
+def top_metric(cur, metric, period, n=10):
+    '''Takes in the cursor, a metric and period stored in DerivedMetrics (see derived_metrics) and how
+    many states to return. Returns a list of (state, value) tuples for the n highest values, highest
+    first, read in order from the DerivedMetrics_top index.'''
+    cur.execute('SELECT States.state, DerivedMetrics.value FROM DerivedMetrics JOIN States ON DerivedMetrics.state_id = States.state_id WHERE DerivedMetrics.metric = ? AND DerivedMetrics.period = ? AND DerivedMetrics.value IS NOT NULL ORDER BY DerivedMetrics.value DESC LIMIT ?', (metric, period, n))
+    return cur.fetchall()
+
+@memoized
+def metric_values(cur, metric, period):
+    '''Takes in the cursor and a metric and period stored in DerivedMetrics. Returns a list of
+    (state, name, value) tuples in state_id order, value being None where it can't be computed.'''
+    cur.execute('SELECT States.state, States.name, DerivedMetrics.value FROM DerivedMetrics JOIN States ON DerivedMetrics.state_id = States.state_id WHERE DerivedMetrics.metric = ? AND DerivedMetrics.period = ? ORDER BY States.state_id', (metric, period))
+    return cur.fetchall()
+
+@memoized
+def metric_frame(cur, metric):
+    '''Takes in the cursor and the name of a metric in MetricTypes (an API field such as death). Reads its
+    CovidMetrics values in one query. Returns a frame with state_id, state, date (YYYYMMDD int) and value
+    columns; days the API had no value for are left out.'''
+    return pd.read_sql_query('SELECT CovidMetrics.state_id, States.state, CAST(Dates.date AS INTEGER) AS date, CovidMetrics.value FROM CovidMetrics JOIN MetricTypes ON CovidMetrics.metric_id = MetricTypes.metric_id JOIN States ON CovidMetrics.state_id = States.state_id JOIN Dates ON CovidMetrics.date_id = Dates.date_id WHERE MetricTypes.name = ? ORDER BY CovidMetrics.state_id, Dates.date', cur.connection, params=(metric,))
+
+@memoized
+def top_by_metric(cur, metric, date, n=10):
+    '''Takes in the cursor, the name of a metric in MetricTypes, a YYYYMMDD date and how many states to
+    return. Returns a list of (state, value) tuples for the n highest values on that date, highest first,
+    read in order from the CovidMetrics_metric index.'''
+    cur.execute('SELECT States.state, CovidMetrics.value FROM CovidMetrics JOIN States ON CovidMetrics.state_id = States.state_id WHERE CovidMetrics.metric_id = (SELECT metric_id FROM MetricTypes WHERE name = ?) AND CovidMetrics.date_id = (SELECT date_id FROM Dates WHERE date = ?) ORDER BY CovidMetrics.value DESC LIMIT ?', (metric, date, n))
+    return cur.fetchall()
+
+@memoized
+def region_series(cur, region, metric):
+    '''Takes in the cursor, the name of a region in Regions (e.g. United States or South) and of a metric
+    in MetricTypes. Returns a list of (date, value, areas) tuples from Rollups, oldest first, areas being
+    how many states, DC and territories the sum covers.'''
+    cur.execute('SELECT CAST(Dates.date AS INTEGER), Rollups.value, Rollups.areas FROM Rollups JOIN Dates ON Rollups.date_id = Dates.date_id WHERE Rollups.region_id = (SELECT region_id FROM Regions WHERE name = ?) AND Rollups.metric_id = (SELECT metric_id FROM MetricTypes WHERE name = ?) ORDER BY Dates.date', (region, metric))
+    return cur.fetchall()
+
+@memoized
+def region_metrics(cur, metric, period):
+    '''Takes in the cursor and a metric and period stored in RegionMetrics (see rollups). Returns a list
+    of (region, level, value) tuples, the nation first.'''
+    cur.execute('SELECT Regions.name, Regions.level, RegionMetrics.value FROM RegionMetrics JOIN Regions ON RegionMetrics.region_id = Regions.region_id WHERE RegionMetrics.metric = ? AND RegionMetrics.period = ? ORDER BY Regions.region_id', (metric, period))
+    return cur.fetchall()
+
+@memoized
+def areas(cur):
+    '''Takes in the cursor. Returns a list of (state, name, type) tuples for every state, DC and territory
+    in state_id order.'''
+    cur.execute('SELECT state, name, type FROM States ORDER BY state_id')
+    return cur.fetchall()
+
+@memoized
+def state_series(cur, state, metric, start_date=None, end_date=None):
+    '''Takes in the cursor, a lowercase state abbreviation, the name of a metric in MetricTypes and
+    optionally the first and last YYYYMMDD dates to include. Returns a list of (date, value) tuples from
+    CovidMetrics, oldest first; days the API had no value for are left out.'''
+    cur.execute('SELECT CAST(Dates.date AS INTEGER), CovidMetrics.value FROM CovidMetrics JOIN Dates ON CovidMetrics.date_id = Dates.date_id WHERE CovidMetrics.state_id = (SELECT state_id FROM States WHERE state = ?) AND CovidMetrics.metric_id = (SELECT metric_id FROM MetricTypes WHERE name = ?) AND Dates.date >= ? AND Dates.date <= ? ORDER BY Dates.date',
+                (state, metric, str(start_date or 0), str(end_date or 99999999)))
+    return cur.fetchall()
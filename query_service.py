@@ -0,0 +1,231 @@
+import json
+import gzip
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from database import setUpDatabase, ConnectionPool
+import queries
+import derived_metrics
+import instrument
+
+#
+# Local read-only HTTP/JSON service over the project database, so dashboards can read the results
+# without opening finalProject.db themselves. Every request borrows one of a few read-only
+# connections, so readers never block the pipeline writing. Encoded responses are kept in an LRU
+# cache that is emptied as soon as another connection commits (PRAGMA data_version), and sent
+# gzipped to clients that accept it. Usage: python query_service.py [--port 8207]
+#
+
+#responses smaller than this are sent as they are, gzip would barely shrink them
+GZIP_MIN_BYTES = 512
+
+#the period every DerivedMetrics metric is read for unless a request names one
+DEFAULT_PERIODS = {metric: derived_metrics.window(*params) for metric, params in derived_metrics.DEFAULT_WINDOWS}
+
+def run(query, cur, *args):
+    '''Runs one of the memoized functions of queries.py without keeping its result, since whole
+    responses are cached here instead. Returns what the query returns.'''
+    return query.__wrapped__(cur, *args)
+
+class NotFound(Exception):
+    '''Raised by an endpoint when what was asked for isn't in the database.'''
+
+def number(params, name, default):
+    '''Returns query parameter name as an int, or default if it wasn't given. Raises ValueError if it
+    isn't a positive number.'''
+    value = int(params.get(name, default))
+    if value <= 0:
+        raise ValueError(f"{name} must be positive")
+    return value
+
+def state_list(cur, params):
+    '''/states: every state, DC and territory with its name and type.'''
+    return [{'state': state, 'name': name, 'type': kind} for state, name, kind in run(queries.areas, cur)]
+
+def series(cur, params, state, metric='positive'):
+    '''/series/<state>[/<metric>][?start=YYYYMMDD&end=YYYYMMDD]: the daily values of a CovidMetrics
+    metric (positive by default) for one state, oldest first.'''
+    rows = run(queries.state_series, cur, state.lower(), metric, params.get('start'), params.get('end'))
+    if not rows and not any(row[0] == state.lower() for row in run(queries.areas, cur)):
+        raise NotFound(f"no state {state}")
+    return {'state': state.lower(), 'metric': metric, 'dates': [date for date, value in rows], 'values': [value for date, value in rows]}
+
+def top(cur, params, metric):
+    '''/top/<metric>[?n=10&period=...|date=YYYYMMDD]: the n states with the highest value, highest first.
+    Metrics in DerivedMetrics are read for period (by default the one the project reports), the API
+    fields in CovidMetrics for date.'''
+    n = number(params, 'n', 10)
+    if 'date' in params:
+        rows = run(queries.top_by_metric, cur, metric, params['date'], n)
+        key = {'date': int(params['date'])}
+    else:
+        if 'period' not in params and metric not in DEFAULT_PERIODS:
+            raise NotFound(f"{metric} is not a derived metric, ask for a date")
+        period = params.get('period', DEFAULT_PERIODS.get(metric))
+        rows = run(queries.top_metric, cur, metric, period, n)
+        key = {'period': period}
+    if not rows:
+        raise NotFound(f"nothing stored for {metric} {key}")
+    return dict(metric=metric, **key, states=[{'state': state, 'value': value} for state, value in rows])
+
+def per_capita(cur, params):
+    '''/per-capita[?date=YYYYMMDD&year=YYYY]: cases on date over the population of year for every state,
+    DC and territory and for the nation and census regions, as precomputed by derived_metrics and
+    rollups (Dec 1st 2020 and 2020 by default).'''
+    period = params.get('period') or derived_metrics.window(params.get('date', 20201201), params.get('year', 2020))
+    states = run(queries.metric_values, cur, 'cases_per_capita', period)
+    if not states:
+        raise NotFound(f"cases_per_capita isn't computed for {period}, add it to derived_metrics.DEFAULT_WINDOWS")
+    regions = run(queries.region_metrics, cur, 'cases_per_capita', period)
+    return {'period': period,
+            'states': [{'state': state, 'name': name, 'value': value} for state, name, value in states],
+            'regions': [{'region': region, 'level': level, 'value': value} for region, level, value in regions]}
+
+def region(cur, params, name, metric='positive'):
+    '''/regions/<name>[/<metric>]: the daily sum of a CovidMetrics metric over a region (United States,
+    Midwest, Northeast, South or West), with how many areas every sum covers.'''
+    rows = run(queries.region_series, cur, name, metric)
+    if not rows:
+        raise NotFound(f"no rollups for {name} {metric}")
+    return {'region': name, 'metric': metric, 'dates': [row[0] for row in rows], 'values': [row[1] for row in rows], 'areas': [row[2] for row in rows]}
+
+#first part of the path to the endpoint answering it; the other parts are passed as arguments
+ROUTES = {
+    'states': state_list,
+    'series': series,
+    'top': top,
+    'per-capita': per_capita,
+    'regions': region,
+}
+
+class QueryService:
+    '''Answers ROUTES requests from a pool of read-only connections to db_name. Up to cache_entries
+    encoded responses are kept, least recently used evicted first; all of them are dropped when the
+    database changed since they were read. Safe to share between threads.'''
+
+    def __init__(self, db_name='finalProject.db', connections=4, cache_entries=256):
+        self.pool = ConnectionPool(db_name, size=connections, read_only=True)
+        #only ever asked for data_version, which changes whenever another connection commits
+        self.watch, self.watch_conn = setUpDatabase(db_name, check_same_thread=False, read_only=True)
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.cache_entries = cache_entries
+        self.version = None
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def data_version(self):
+        '''Returns the current data version, first emptying the caches if the database changed.'''
+        with self.lock:
+            self.watch.execute('PRAGMA data_version')
+            version = self.watch.fetchone()[0]
+            if version != self.version:
+                if self.version is not None:
+                    self.stats['invalidations'] += 1
+                self.version = version
+                self.results.clear()
+            return version
+
+    def get(self, path):
+        '''Takes in a request path with its query string. Returns a (status, body, gzipped body) tuple,
+        the bodies being encoded JSON; the gzipped body is None when the plain one is too small to bother.'''
+        version = self.data_version()
+        with self.lock:
+            cached = self.results.get(path)
+            if cached is not None:
+                self.results.move_to_end(path)
+                self.stats['hits'] += 1
+                return cached
+
+        url = urlsplit(path)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        params = dict(parse_qsl(url.query))
+        if not parts or parts[0] not in ROUTES:
+            return self.encode(404, {'error': f"unknown endpoint, try one of /{', /'.join(ROUTES)}"})
+        try:
+            with self.pool.connection() as (cur, conn):
+                response = self.encode(200, ROUTES[parts[0]](cur, params, *parts[1:]))
+        except NotFound as e:
+            return self.encode(404, {'error': str(e)})
+        except (TypeError, ValueError) as e:
+            return self.encode(400, {'error': str(e)})
+
+        with self.lock:
+            self.stats['misses'] += 1
+            #a commit while the query ran means the result may already be stale
+            if version == self.version:
+                self.results[path] = response
+                if len(self.results) > self.cache_entries:
+                    self.results.popitem(last=False)
+        instrument.count('service_queries')
+        return response
+
+    def encode(self, status, value):
+        body = json.dumps(value, separators=(',', ':')).encode()
+        return status, body, gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None
+
+    def close(self):
+        self.pool.close()
+        self.watch_conn.close()
+
+def make_handler(service):
+    '''Returns a request handler class answering GET requests from a QueryService.'''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            status, body, gzipped = service.get(self.path)
+            accepts = 'gzip' in self.headers.get('Accept-Encoding', '')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Vary', 'Accept-Encoding')
+            if gzipped is not None and accepts:
+                body = gzipped
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+def start_service(db_name='finalProject.db', host='127.0.0.1', port=0, connections=4, cache_entries=256):
+    '''Takes in the database name, the address to listen on (port 0 picks a free one), the number of
+    read-only connections and of cached responses. Starts the service in a background thread and returns
+    the server; url and service (the QueryService) are set on it. Call shutdown() and then
+    service.close() to stop it.'''
+    service = QueryService(db_name, connections, cache_entries)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    server.service = service
+    host, port = server.server_address
+    server.url = f"http://{host}:{port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the COVID and population results as JSON over HTTP.')
+    parser.add_argument('--db', default='finalProject.db', help='database file (default: finalProject.db next to this script)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8207)
+    parser.add_argument('--connections', type=int, default=4, help='read-only connections, i.e. queries run at the same time')
+    parser.add_argument('--cache-entries', type=int, default=256, help='responses kept in memory')
+    args = parser.parse_args()
+
+    instrument.reset()
+    server = start_service(args.db, args.host, args.port, args.connections, args.cache_entries)
+    print(f"Serving {args.db} on {server.url}/{{{','.join(ROUTES)}}}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        server.service.close()
+
+if __name__ == "__main__":
+    main()
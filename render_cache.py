@@ -0,0 +1,95 @@
+import sqlite3
+import os
+import json
+import time
+import hashlib
+import threading
+import queries
+from database import evict_lru
+import instrument
+
+#
+# Persistent cache of rendered charts used by viz.render_all()
+#
+
+def key(params):
+    '''Takes in a dictionary of everything besides the data that decides how a chart looks (name, format,
+    size, code...). Returns the key its image is stored under.'''
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def digest(results):
+    '''Takes in a list of (query name, arguments, result) as recorded by queries.recording(). Returns a hash
+    of the results, which changes whenever the data a chart was drawn from does.'''
+    hashed = hashlib.sha1()
+    for name, params, result in results:
+        hashed.update(repr((name, tuple(params))).encode())
+        hashed.update((result.to_csv() if hasattr(result, 'to_csv') else repr(result)).encode())
+    return hashed.hexdigest()
+
+def fingerprint(cur, calls):
+    '''Takes in the cursor and a list of (query name, arguments) calls. Runs every call again (memoized, so
+    usually for free) and returns the digest() of the results the database holds now.'''
+    results = []
+    for name, params in calls:
+        params = tuple(tuple(value) if isinstance(value, list) else value for value in params)
+        results.append((name, params, getattr(queries, name)(cur, *params)))
+    return digest(results)
+
+class RenderCache:
+    '''On-disk cache of rendered chart files keyed by key(params), stored in a sqlite file next to the
+    scripts. Every entry keeps the queries the chart read and the fingerprint of their results, so a chart
+    is only drawn again when its data, its code or its parameters changed. When the images add up to more
+    than max_bytes the least recently used entries are evicted. Safe to share between threads.'''
+
+    def __init__(self, filename='render_cache.db', max_bytes=50 * 1024 * 1024):
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.conn = sqlite3.connect(os.path.join(path, filename), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS Renders ("key" TEXT PRIMARY KEY, "chart" TEXT, "calls" TEXT, "fingerprint" TEXT, "last_used" REAL, "size" INTEGER, "body" BLOB)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS Renders_last_used ON Renders (last_used)')
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def lookup(self, cur, keys):
+        '''Takes in the cursor of the project database and the keys of every file of one chart. Returns the
+        list of stored images in the same order if all of them are cached and were drawn from the same data
+        as the database holds now, None otherwise.'''
+        with self.lock:
+            rows = {row[0]: row[1:] for row in self.conn.execute(f"SELECT key, calls, fingerprint, body FROM Renders WHERE key IN ({', '.join('?' * len(keys))})", keys)}
+        if len(rows) < len(keys):
+            self._count('misses')
+            return None
+        #every file of a chart is stored from the same render, so they share their calls and fingerprint
+        calls, digest, body = rows[keys[0]]
+        if any(row[1] != digest for row in rows.values()) or fingerprint(cur, json.loads(calls)) != digest:
+            self._count('misses')
+            return None
+
+        with self.lock:
+            self.conn.execute(f"UPDATE Renders SET last_used = ? WHERE key IN ({', '.join('?' * len(keys))})", [time.time()] + list(keys))
+            self.conn.commit()
+        self._count('hits')
+        return [rows[file_key][2] for file_key in keys]
+
+    def store(self, chart, files, calls, digest):
+        '''Takes in the chart name, a list of (key, path) of the files it was saved to, the queries it read
+        and the fingerprint of their results. Stores the files' contents.'''
+        now = time.time()
+        rows = []
+        for file_key, path in files:
+            with open(path, 'rb') as f:
+                body = f.read()
+            rows.append((file_key, chart, json.dumps(calls), digest, now, len(body), body))
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO Renders (key, chart, calls, fingerprint, last_used, size, body) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            evict_lru(self.conn, 'Renders', 'key', self.max_bytes)
+            self.conn.commit()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+        instrument.count(f"render_cache_{name}")
+
+    def close(self):
+        self.conn.close()
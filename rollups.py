@@ -0,0 +1,71 @@
+import instrument
+from derived_metrics import DEFAULT_WINDOWS, window
+
+#
+# Precomputed sums above the state level. Rollups holds, for every region of the hierarchy (the nation
+# and the census regions, see database.state_table), the sum of every CovidMetrics value by date, and
+# RegionPopulation the sum of Population by year; RegionMetrics holds the rates and percent changes
+# computed from them. Triggers mark the dates and years that changed, and refresh() only sums those.
+#
+
+#the CovidMetrics field the case metrics are computed from
+CASES_METRIC = 'positive'
+
+#sum of every metric for every region on the marked dates (all dates if {where} is empty)
+DATE_SUMS = '''INSERT INTO Rollups (region_id, metric_id, date_id, value, areas)
+    SELECT RegionMembers.region_id, CovidMetrics.metric_id, CovidMetrics.date_id, SUM(CovidMetrics.value), COUNT(*)
+    FROM CovidMetrics JOIN RegionMembers ON RegionMembers.state_id = CovidMetrics.state_id
+    {where} GROUP BY RegionMembers.region_id, CovidMetrics.metric_id, CovidMetrics.date_id'''
+#lets the (metric_id, date_id) index find the marked dates
+DIRTY_DATES = "WHERE CovidMetrics.metric_id IN (SELECT metric_id FROM MetricTypes) AND CovidMetrics.date_id IN (SELECT key FROM DirtyRollups WHERE kind = 'date')"
+
+YEAR_SUMS = '''INSERT INTO RegionPopulation (region_id, year, population, areas)
+    SELECT RegionMembers.region_id, Population.year, SUM(Population.population), COUNT(*)
+    FROM Population JOIN RegionMembers ON RegionMembers.state_id = Population.state_id
+    {where} GROUP BY RegionMembers.region_id, Population.year'''
+DIRTY_YEARS = "WHERE Population.year IN (SELECT key FROM DirtyRollups WHERE kind = 'year')"
+
+#the same metrics as derived_metrics.VALUES, per region; NULL when the two sums don't cover the same areas
+CASES_AT = '''LEFT JOIN Rollups AS {alias} ON {alias}.region_id = Regions.region_id
+    AND {alias}.metric_id = (SELECT metric_id FROM MetricTypes WHERE name = '{metric}')
+    AND {alias}.date_id = (SELECT date_id FROM Dates WHERE date = ?)'''
+POPULATION_IN = 'LEFT JOIN RegionPopulation AS {alias} ON {alias}.region_id = Regions.region_id AND {alias}.year = ?'
+VALUES = {
+    'percent_change': '''CASE WHEN start_sums.areas = end_sums.areas THEN (end_sums.value - start_sums.value) * 100.0 / NULLIF(start_sums.value, 0) END
+        FROM Regions ''' + CASES_AT.format(alias='start_sums', metric=CASES_METRIC) + ' ' + CASES_AT.format(alias='end_sums', metric=CASES_METRIC),
+    'cases_per_capita': '''CASE WHEN cases.areas = pop.areas THEN CAST(cases.value AS REAL) / NULLIF(pop.population, 0) END
+        FROM Regions ''' + CASES_AT.format(alias='cases', metric=CASES_METRIC) + ' ' + POPULATION_IN.format(alias='pop'),
+    'population_growth': '''CASE WHEN base.areas = pop.areas THEN CAST(pop.population AS REAL) / NULLIF(base.population, 0) END
+        FROM Regions ''' + POPULATION_IN.format(alias='base') + ' ' + POPULATION_IN.format(alias='pop'),
+}
+
+@instrument.timed('refresh_rollups')
+def refresh(cur, conn, windows=DEFAULT_WINDOWS):
+    '''Takes in the cursor and connection variables and a list of (metric, params) tuples like
+    derived_metrics.refresh(). Sums CovidMetrics and Population again for every region, but only for the
+    dates and years marked in DirtyRollups (everything if a rollup table is empty, e.g. after the hierarchy
+    changed), then recomputes RegionMetrics for the given windows if any sum changed. Commits and returns
+    the number of sums written; 0 when nothing changed since the last refresh.'''
+    written = 0
+    for table, sums, marked, kind, column in (('Rollups', DATE_SUMS, DIRTY_DATES, 'date', 'date_id'),
+                                              ('RegionPopulation', YEAR_SUMS, DIRTY_YEARS, 'year', 'year')):
+        cur.execute(f'SELECT 1 FROM {table} LIMIT 1')
+        if cur.fetchone() is None:
+            cur.execute(sums.format(where=''))
+        else:
+            cur.execute(f"DELETE FROM {table} WHERE {column} IN (SELECT key FROM DirtyRollups WHERE kind = ?)", (kind,))
+            cur.execute(sums.format(where=marked))
+        written += max(cur.rowcount, 0)
+    cur.execute('SELECT COUNT(*) FROM DirtyRollups')
+    dirty = cur.fetchone()[0]
+    cur.execute('DELETE FROM DirtyRollups')
+
+    cur.execute('SELECT 1 FROM RegionMetrics LIMIT 1')
+    if written or dirty or cur.fetchone() is None:
+        cur.execute('DELETE FROM RegionMetrics')
+        for metric, params in windows:
+            cur.execute(f'INSERT INTO RegionMetrics (region_id, metric, period, value) SELECT Regions.region_id, ?, ?, {VALUES[metric]}',
+                        [metric, window(*params)] + list(params))
+    conn.commit()
+    instrument.count('rollups_written', written)
+    return written
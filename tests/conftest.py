@@ -0,0 +1,59 @@
+import os
+import sys
+import sqlite3
+
+#the scripts import each other as top level modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from database import setUpDatabase, create_tables
+import covid_data
+import population_data
+
+#positive cases on the report's two dates and the 2010 and 2020 census of a few states
+CASES = {'mi': (400000, 650000), 'oh': (420000, 960000), 'il': (730000, 1200000), 'ca': (1300000, 3500000)}
+POPULATION = {
+    2010: {'Michigan': '9,883,640', 'Ohio': '11,536,504', 'Illinois': '12,830,632', 'California': '37,253,956'},
+    2020: {'Michigan': '10,077,331', 'Ohio': '11,799,448', 'Illinois': '12,812,508', 'California': '39,538,223'},
+}
+
+def write_cases(cur, conn, state, date, positive):
+    '''Upserts one day of one state the way the sync does, into CovidData and CovidMetrics.'''
+    cur.execute('SELECT state_id FROM States WHERE state = ?', (state,))
+    state_id = cur.fetchone()[0]
+    date_id = covid_data.date_ids(cur, conn, [date])[date]
+    covid_data.covid_table(cur, conn, state_id, date_id, positive)
+    covid_data.metrics_table(cur, conn, state_id, date_id, {'positive': positive}, covid_data.metric_ids(cur, conn, ['positive']))
+
+def old_database(path):
+    '''Writes a database laid out like the original scripts left it: States without names and
+    Population rows keyed by a "Name:year" string, with a second run's duplicates.'''
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE States ("state_id" INTEGER PRIMARY KEY, "state" TEXT)')
+    conn.executemany('INSERT INTO States (state) VALUES (?)', [('mi',), ('oh',)])
+    conn.execute('CREATE TABLE Population ("id" INTEGER PRIMARY KEY, "state" TEXT, "population" INTEGER)')
+    conn.executemany('INSERT INTO Population (id, state, population) VALUES (?, ?, ?)', [
+        (1, 'Michigan:2010', '9,883,640'),
+        (2, 'Ohio:2010', '11,536,504'),
+        (3, 'Michigan:2020', '10,077,331'),
+        (4, 'Ohio:2020', '11,799,448'),
+        (5, 'Narnia:2020', '1,000'),
+        #the second run scraped a corrected figure
+        (6, 'Michigan:2020', '10,077,332'),
+    ])
+    conn.commit()
+    conn.close()
+
+@pytest.fixture
+def db(tmp_path):
+    '''A project database holding CASES and POPULATION. Yields (cur, conn).'''
+    cur, conn = setUpDatabase(str(tmp_path / 'test.db'))
+    create_tables(cur, conn)
+    for state, (start, end) in CASES.items():
+        write_cases(cur, conn, state, 20201201, start)
+        write_cases(cur, conn, state, 20210307, end)
+    for year, pops in POPULATION.items():
+        population_data.pop_table(cur, conn, pops, year)
+    yield cur, conn
+    conn.close()
@@ -0,0 +1,84 @@
+import pytest
+import derived_metrics
+import covid_data
+import population_data
+from conftest import CASES, write_cases
+
+def areas(cur):
+    cur.execute('SELECT COUNT(*) FROM States')
+    return cur.fetchone()[0]
+
+def value(cur, state, metric, period):
+    cur.execute('''SELECT value FROM DerivedMetrics JOIN States ON DerivedMetrics.state_id = States.state_id
+        WHERE state = ? AND metric = ? AND period = ?''', (state, metric, period))
+    return cur.fetchone()[0]
+
+def test_first_refresh_computes_everything(db):
+    cur, conn = db
+    assert derived_metrics.refresh(cur, conn) == areas(cur) * len(derived_metrics.DEFAULT_WINDOWS)
+    start, end = CASES['mi']
+    assert value(cur, 'mi', 'percent_change', '20201201-20210307') == pytest.approx((end - start) * 100 / start)
+    assert value(cur, 'mi', 'cases_per_capita', '20201201-2020') == pytest.approx(start / 10077331)
+    assert value(cur, 'mi', 'population_growth', '2010-2020') == pytest.approx(10077331 / 9883640)
+    #no data, no value
+    assert value(cur, 'wy', 'percent_change', '20201201-20210307') is None
+
+def test_second_refresh_computes_nothing(db):
+    cur, conn = db
+    derived_metrics.refresh(cur, conn)
+    assert derived_metrics.refresh(cur, conn) == 0
+
+def test_unchanged_rewrite_computes_nothing(db):
+    cur, conn = db
+    derived_metrics.refresh(cur, conn)
+    write_cases(cur, conn, 'mi', 20210307, CASES['mi'][1])
+    cur.execute('SELECT COUNT(*) FROM DirtyStates')
+    assert cur.fetchone()[0] == 0
+    assert derived_metrics.refresh(cur, conn) == 0
+
+def test_changed_cases_recompute_that_state(db):
+    cur, conn = db
+    derived_metrics.refresh(cur, conn)
+    other = value(cur, 'oh', 'percent_change', '20201201-20210307')
+    write_cases(cur, conn, 'mi', 20210307, 800000)
+
+    #percent_change and cases_per_capita of mi read CovidData; population_growth doesn't
+    assert derived_metrics.refresh(cur, conn) == 2
+    assert value(cur, 'mi', 'percent_change', '20201201-20210307') == pytest.approx((800000 - 400000) * 100 / 400000)
+    assert value(cur, 'oh', 'percent_change', '20201201-20210307') == other
+    assert derived_metrics.refresh(cur, conn) == 0
+
+def test_changed_population_recompute_that_state(db):
+    cur, conn = db
+    derived_metrics.refresh(cur, conn)
+    population_data.pop_table(cur, conn, {'Ohio': '12,000,000'}, 2020)
+
+    #cases_per_capita and population_growth of oh read Population; percent_change doesn't
+    assert derived_metrics.refresh(cur, conn) == 2
+    assert value(cur, 'oh', 'population_growth', '2010-2020') == pytest.approx(12000000 / 11536504)
+
+def test_new_window_only_computes_that_window(db):
+    cur, conn = db
+    derived_metrics.refresh(cur, conn)
+    windows = derived_metrics.DEFAULT_WINDOWS + [('cases_per_capita', (20210307, 2020))]
+    assert derived_metrics.refresh(cur, conn, windows) == areas(cur)
+    assert value(cur, 'ca', 'cases_per_capita', '20210307-2020') == pytest.approx(CASES['ca'][1] / 39538223)
+    assert derived_metrics.refresh(cur, conn, windows) == 0
+
+def test_added_window_survives_changes(db):
+    cur, conn = db
+    derived_metrics.refresh(cur, conn)
+    covid_data.percent_change(cur, conn, ['mi', 'oh'], 20201201, 20210307)
+    cur.execute('SELECT COUNT(*) FROM MetricWindows')
+    assert cur.fetchone()[0] == 0
+
+    #any window besides the report's is kept up to date by refresh()
+    write_cases(cur, conn, 'mi', 20201204, 500000)
+    write_cases(cur, conn, 'oh', 20201204, 450000)
+    assert covid_data.percent_change(cur, conn, ['mi', 'oh'], 20201201, 20201204) == pytest.approx([25.0, 450000 * 100 / 420000 - 100])
+    derived_metrics.refresh(cur, conn)
+    write_cases(cur, conn, 'mi', 20201204, 600000)
+    derived_metrics.refresh(cur, conn)
+    assert value(cur, 'mi', 'percent_change', '20201201-20201204') == pytest.approx(50.0)
+    assert value(cur, 'oh', 'percent_change', '20201201-20201204') == pytest.approx(450000 * 100 / 420000 - 100)
+    assert derived_metrics.stored_windows(cur, conn) == [('percent_change', (20201201, 20201204))]
@@ -0,0 +1,54 @@
+import json
+import random
+import pytest
+from covid_data import iter_json_array
+
+RECORDS = [
+    {'date': 20210307, 'state': 'MI', 'positive': 656072, 'death': None, 'note': 'a "quoted" [bracket], {brace}'},
+    {'date': 20210306, 'state': 'MI', 'positive': 655535, 'death': 16990, 'nested': {'list': [1, 2.5, -3e2]}},
+    {'date': 20210305, 'state': 'MI', 'positive': 654676, 'death': 16977, 'unicode': 'café – über'},
+]
+
+def split(text, points):
+    '''Returns text cut at the given sorted offsets.'''
+    bounds = [0] + points + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_every_split_point(indent):
+    text = json.dumps(RECORDS, indent=indent)
+    for point in range(len(text) + 1):
+        assert list(iter_json_array(split(text, [point]))) == RECORDS
+
+def test_random_chunks():
+    text = json.dumps(RECORDS * 20)
+    rng = random.Random(206)
+    for trial in range(200):
+        points = sorted(rng.sample(range(1, len(text)), rng.randint(1, 40)))
+        assert list(iter_json_array(split(text, points))) == json.loads(text)
+
+def test_one_character_chunks():
+    text = json.dumps(RECORDS)
+    assert list(iter_json_array(iter(text))) == RECORDS
+
+def test_empty_array():
+    assert list(iter_json_array([' [', ' ] '])) == []
+
+def test_yields_before_the_array_ends():
+    text = json.dumps(RECORDS)
+    first = text.index('}, {') + 1
+
+    def chunks():
+        yield text[:first]
+        raise AssertionError('read past the first record')
+
+    assert next(iter_json_array(chunks())) == RECORDS[0]
+
+def test_not_an_array():
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"date": 20210307}']))
+
+def test_truncated():
+    text = json.dumps(RECORDS)
+    with pytest.raises(ValueError):
+        list(iter_json_array([text[:len(text) // 2]]))
@@ -0,0 +1,44 @@
+from database import setUpDatabase, create_tables, migrate_population
+from conftest import old_database
+
+def population(cur):
+    cur.execute('SELECT States.state, Population.year, Population.population FROM Population JOIN States ON Population.state_id = States.state_id')
+    return sorted(cur.fetchall())
+
+def test_converts_old_layout(tmp_path):
+    path = str(tmp_path / 'old.db')
+    old_database(path)
+    cur, conn = setUpDatabase(path)
+    create_tables(cur, conn)
+
+    cur.execute('PRAGMA table_info(Population)')
+    assert [row[1] for row in cur.fetchall()] == ['id', 'state_id', 'year', 'population']
+    assert population(cur) == [('mi', 2010, 9883640), ('mi', 2020, 10077332), ('oh', 2010, 11536504), ('oh', 2020, 11799448)]
+    #the States rows the old scripts made keep their ids
+    cur.execute("SELECT state_id FROM States WHERE state IN ('mi', 'oh') ORDER BY state")
+    assert [row[0] for row in cur.fetchall()] == [1, 2]
+    conn.close()
+
+def test_leaves_normalized_table_alone(tmp_path):
+    path = str(tmp_path / 'old.db')
+    old_database(path)
+    cur, conn = setUpDatabase(path)
+    create_tables(cur, conn)
+    before = population(cur)
+
+    migrate_population(cur, conn)
+    create_tables(cur, conn)
+    assert population(cur) == before
+    conn.close()
+
+def test_migrated_table_takes_upserts(tmp_path):
+    import population_data
+    path = str(tmp_path / 'old.db')
+    old_database(path)
+    cur, conn = setUpDatabase(path)
+    create_tables(cur, conn)
+
+    assert population_data.pop_table(cur, conn, {'Michigan': '10,077,332', 'Ohio': '11,799,448'}, 2020) == 0
+    assert population_data.pop_table(cur, conn, {'Ohio': '11,800,000'}, 2020) == 1
+    assert ('oh', 2020, 11800000) in population(cur)
+    conn.close()
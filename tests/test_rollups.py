@@ -0,0 +1,64 @@
+import pytest
+import rollups
+from database import NATION
+import population_data
+from conftest import CASES, write_cases
+
+MIDWEST = ('mi', 'oh', 'il')
+
+def rollup(cur, region, date):
+    '''Returns the stored (sum, areas) of positive cases for region on date.'''
+    cur.execute('''SELECT Rollups.value, Rollups.areas FROM Rollups JOIN Regions ON Rollups.region_id = Regions.region_id
+        JOIN Dates ON Rollups.date_id = Dates.date_id WHERE Regions.name = ? AND Dates.date = ?''', (region, str(date)))
+    return cur.fetchone()
+
+def region_metric(cur, region, metric, period):
+    cur.execute('''SELECT value FROM RegionMetrics JOIN Regions ON RegionMetrics.region_id = Regions.region_id
+        WHERE Regions.name = ? AND metric = ? AND period = ?''', (region, metric, period))
+    return cur.fetchone()[0]
+
+def test_first_refresh_sums_every_region(db):
+    cur, conn = db
+    #the nation, the Midwest and the West on two dates, and the same for the two census years
+    assert rollups.refresh(cur, conn) == 12
+    assert rollup(cur, NATION, 20210307) == (sum(end for start, end in CASES.values()), len(CASES))
+    assert rollup(cur, 'Midwest', 20201201) == (sum(CASES[state][0] for state in MIDWEST), len(MIDWEST))
+    assert rollup(cur, 'South', 20201201) is None
+    start = sum(CASES[state][0] for state in MIDWEST)
+    end = sum(CASES[state][1] for state in MIDWEST)
+    assert region_metric(cur, 'Midwest', 'percent_change', '20201201-20210307') == pytest.approx((end - start) * 100 / start)
+
+def test_second_refresh_sums_nothing(db):
+    cur, conn = db
+    rollups.refresh(cur, conn)
+    assert rollups.refresh(cur, conn) == 0
+    write_cases(cur, conn, 'mi', 20210307, CASES['mi'][1])
+    assert rollups.refresh(cur, conn) == 0
+
+def test_changed_date_is_summed_again(db):
+    cur, conn = db
+    rollups.refresh(cur, conn)
+    before = rollup(cur, NATION, 20201201)
+    write_cases(cur, conn, 'mi', 20210307, CASES['mi'][1] + 1000)
+
+    #only 20210307 is summed again, for the three regions with cases on it
+    assert rollups.refresh(cur, conn) == 3
+    assert rollup(cur, NATION, 20210307)[0] == sum(end for start, end in CASES.values()) + 1000
+    assert rollup(cur, NATION, 20201201) == before
+    assert rollups.refresh(cur, conn) == 0
+
+def test_changed_year_is_summed_again(db):
+    cur, conn = db
+    rollups.refresh(cur, conn)
+    population_data.pop_table(cur, conn, {'California': '40,000,000'}, 2020)
+    assert rollups.refresh(cur, conn) == 3
+    cur.execute("SELECT population FROM RegionPopulation JOIN Regions ON RegionPopulation.region_id = Regions.region_id WHERE name = 'West' AND year = 2020")
+    assert cur.fetchone()[0] == 40000000
+
+def test_uneven_coverage_has_no_rate(db):
+    cur, conn = db
+    #a state with cases on one date only makes the Midwest sums cover different areas
+    write_cases(cur, conn, 'in', 20210307, 650000)
+    rollups.refresh(cur, conn)
+    assert rollup(cur, 'Midwest', 20210307)[1] == len(MIDWEST) + 1
+    assert region_metric(cur, 'Midwest', 'percent_change', '20201201-20210307') is None
@@ -0,0 +1,103 @@
+import json
+import pytest
+import requests
+import covid_data
+import mock_server
+from database import setUpDatabase, create_tables, load_states
+from conftest import old_database
+
+DAYS = 30
+END_DATE = 20210307
+STATES = [state for state, name in load_states()]
+
+@pytest.fixture(scope='module')
+def server():
+    server = mock_server.start_server(days=DAYS, end_date=END_DATE)
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    '''A database from the original scripts, whose States rows (mi, oh) aren't in states.csv order.'''
+    path = str(tmp_path / 'old.db')
+    old_database(path)
+    cur, conn = setUpDatabase(path)
+    create_tables(cur, conn)
+    yield cur, conn
+    conn.close()
+
+def requests_made(server):
+    with server.stats_lock:
+        return server.stats['requests']
+
+def stored(cur, state):
+    '''Returns the newest date and its positive cases stored for state.'''
+    cur.execute('''SELECT CAST(Dates.date AS INTEGER), CovidData.number_of_cases FROM CovidData
+        JOIN States ON CovidData.state_id = States.state_id JOIN Dates ON CovidData.date_id = Dates.date_id
+        WHERE States.state = ? ORDER BY Dates.date DESC LIMIT 1''', (state,))
+    return cur.fetchone()
+
+def current(server, state):
+    return json.loads(requests.get(f"{server.base_url}/{state}/current.json", timeout=10).content)
+
+def test_sync_once_then_nothing(server, legacy_db):
+    cur, conn = legacy_db
+    assert covid_data.sync(cur, conn, STATES, base_url=server.base_url) == DAYS * len(STATES)
+
+    before = requests_made(server)
+    assert covid_data.sync(cur, conn, STATES, base_url=server.base_url) == 0
+    #only current.json is asked for when nothing is behind
+    assert requests_made(server) - before == len(STATES)
+
+def test_states_keep_their_ids(server, legacy_db):
+    cur, conn = legacy_db
+    covid_data.sync(cur, conn, STATES, base_url=server.base_url)
+    cur.execute("SELECT state, state_id FROM States WHERE state IN ('mi', 'oh', 'al')")
+    assert dict(cur.fetchall()) == {'mi': 1, 'oh': 2, 'al': 3}
+    for state in ('mi', 'oh', 'al', 'wy'):
+        day = current(server, state)
+        assert stored(cur, state) == (day['date'], day['positive'])
+
+def test_only_new_days_are_fetched(server, legacy_db):
+    cur, conn = legacy_db
+    covid_data.sync(cur, conn, STATES, base_url=server.base_url)
+
+    #the API moved on two days
+    later = mock_server.start_server(days=DAYS + 2, end_date=20210309)
+    try:
+        assert covid_data.sync(cur, conn, STATES, base_url=later.base_url) == 2 * len(STATES)
+        assert requests_made(later) == 2 * len(STATES)
+        day = current(later, 'mi')
+        assert stored(cur, 'mi') == (day['date'], day['positive'])
+        assert covid_data.sync(cur, conn, STATES, base_url=later.base_url) == 0
+    finally:
+        later.shutdown()
+
+def test_stream_sync_keeps_state_ids(server, legacy_db):
+    cur, conn = legacy_db
+    assert covid_data.stream_sync(cur, conn, STATES, base_url=server.base_url) == DAYS * len(STATES)
+    for state in ('mi', 'oh', 'al'):
+        day = current(server, state)
+        assert stored(cur, state) == (day['date'], day['positive'])
+    assert covid_data.stream_sync(cur, conn, STATES, base_url=server.base_url) == 0
+
+@pytest.mark.parametrize('error', [requests.exceptions.ChunkedEncodingError('connection dropped'),
+                                   covid_data.TruncatedJSON('JSON array ended early')])
+def test_stream_sync_retries_cut_off_downloads(server, legacy_db, monkeypatch, error):
+    cur, conn = legacy_db
+    stream_records = covid_data.stream_records
+    failed = set()
+
+    def cut_off(session, url, *args, **kwargs):
+        #every state's first download drops after a few records
+        for i, day in enumerate(stream_records(session, url, *args, **kwargs)):
+            if i == 3 and url not in failed:
+                failed.add(url)
+                raise error
+            yield day
+
+    monkeypatch.setattr(covid_data, 'stream_records', cut_off)
+    assert covid_data.stream_sync(cur, conn, STATES, base_url=server.base_url, backoff=0) == DAYS * len(STATES)
+    assert len(failed) == len(STATES)
+    day = current(server, 'mi')
+    assert stored(cur, 'mi') == (day['date'], day['positive'])
@@ -0,0 +1,181 @@
+import os
+import datetime
+import numpy as np
+
+#
+# Optional columnar backend for daily per-state series. Each metric is one flat file of fixed-width
+# int64 values laid out day by day (one row of every state per day, in state_id order) and read
+# through a memory map, so any date range is a zero-copy NumPy view. The first date, number of days
+# and number of states of every file are kept in the TimeSeries table of the project database.
+#
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+DTYPE = np.dtype('<i8')
+#stored where a state has no value for a day
+MISSING = np.iinfo(DTYPE).min
+
+def to_day(date):
+    '''Takes in a YYYYMMDD int. Returns it as a datetime.date.'''
+    return datetime.datetime.strptime(str(date), '%Y%m%d').date()
+
+def to_date(day):
+    '''Takes in a datetime.date. Returns it as a YYYYMMDD int.'''
+    return int(day.strftime('%Y%m%d'))
+
+#(date, state_id, value) rows to load, from a date on
+CASES_QUERY = '''SELECT CAST(Dates.date AS INTEGER), CovidData.state_id, CovidData.number_of_cases
+    FROM CovidData JOIN Dates ON CovidData.date_id = Dates.date_id
+    WHERE CAST(Dates.date AS INTEGER) >= ? AND CovidData.number_of_cases IS NOT NULL'''
+METRIC_QUERY = '''SELECT CAST(Dates.date AS INTEGER), CovidMetrics.state_id, CovidMetrics.value
+    FROM CovidMetrics JOIN Dates ON CovidMetrics.date_id = Dates.date_id JOIN MetricTypes ON CovidMetrics.metric_id = MetricTypes.metric_id
+    WHERE CAST(Dates.date AS INTEGER) >= ? AND MetricTypes.name = ? AND CovidMetrics.value IS NOT NULL'''
+
+class TimeSeriesStore:
+    '''Memory-mapped (day, state) int64 arrays, one file per metric in directory (relative to this
+    folder unless absolute). SQLite holds the metadata, the files only the values. New days are added
+    with append() or write(), and view() returns read-only zero-copy views of any date range. The
+    TimeSeries table must already exist (see create_tables).'''
+
+    def __init__(self, cur, conn, directory='timeseries'):
+        self.cur = cur
+        self.conn = conn
+        self.directory = os.path.join(PATH, directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.maps = {}
+
+    def path(self, metric):
+        '''Returns the file a metric's values are stored in.'''
+        return os.path.join(self.directory, f"{metric}.i8")
+
+    def info(self, metric):
+        '''Returns a (start_date, days, states) tuple for a stored metric, or None if it isn't stored.'''
+        self.cur.execute('SELECT start_date, days, states FROM TimeSeries WHERE metric = ?', (metric,))
+        return self.cur.fetchone()
+
+    def append(self, metric, start_date, values):
+        '''Takes in a metric name, the YYYYMMDD date of the first new day and the values of one day (a
+        sequence with one value per state) or of several (a days by states array). The first day must be
+        the day after the last stored one; a new metric starts at start_date. Returns the number of days
+        stored.'''
+        values = np.asarray(values, dtype=DTYPE)
+        if values.ndim == 1:
+            values = values[np.newaxis, :]
+
+        info = self.info(metric)
+        if info is None:
+            info = (start_date, 0, values.shape[1])
+            self.cur.execute('INSERT INTO TimeSeries (metric, start_date, days, states) VALUES (?, ?, ?, ?)', (metric,) + info)
+        first, days, states = info
+        if values.shape[1] != states:
+            raise ValueError(f"{metric} holds {states} states, got {values.shape[1]}")
+        if to_day(start_date) != to_day(first) + datetime.timedelta(days=days):
+            raise ValueError(f"{metric} continues on day {days} after {first}, got {start_date}")
+
+        #bytes past the stored days are left over from a write that was never committed
+        with open(self.path(metric), 'ab') as f:
+            f.truncate(days * states * DTYPE.itemsize)
+            f.write(np.ascontiguousarray(values).tobytes())
+        self.cur.execute('UPDATE TimeSeries SET days = ? WHERE metric = ?', (days + len(values), metric))
+        self.conn.commit()
+        self.maps.pop(metric, None)
+        return days + len(values)
+
+    def write(self, metric, start_date, values):
+        '''Takes in a metric name, a YYYYMMDD date and a days by states array. Overwrites the days already
+        stored from start_date on in place and appends the rest, so corrected history and new days can be
+        written in one call. Returns the number of days stored.'''
+        values = np.asarray(values, dtype=DTYPE)
+        info = self.info(metric)
+        if info is None:
+            return self.append(metric, start_date, values)
+
+        first, days, states = info
+        offset = (to_day(start_date) - to_day(first)).days
+        if offset < 0 or offset > days:
+            raise ValueError(f"{start_date} is outside the {days} days of {metric} from {first}")
+        stored = min(len(values), days - offset)
+        if stored:
+            data = np.memmap(self.path(metric), dtype=DTYPE, mode='r+', shape=(days, states))
+            data[offset:offset + stored] = values[:stored]
+            data.flush()
+            del data
+        if stored < len(values):
+            return self.append(metric, to_date(to_day(start_date) + datetime.timedelta(days=stored)), values[stored:])
+        return days
+
+    def view(self, metric, start_date=None, end_date=None):
+        '''Takes in a metric name and optionally the first and last YYYYMMDD dates to include. Returns a
+        read-only days by states view of the memory-mapped file, without copying; MISSING marks days a
+        state has no value for.'''
+        info = self.info(metric)
+        if info is None:
+            raise KeyError(metric)
+        first, days, states = info
+        if self.maps.get(metric, (None,))[0] != days:
+            data = np.memmap(self.path(metric), dtype=DTYPE, mode='r', shape=(days, states)) if days else np.empty((0, states), DTYPE)
+            self.maps[metric] = (days, data)
+        data = self.maps[metric][1]
+
+        start = 0 if start_date is None else max((to_day(start_date) - to_day(first)).days, 0)
+        end = days if end_date is None else min((to_day(end_date) - to_day(first)).days + 1, days)
+        return data[start:max(start, end)]
+
+    def dates(self, metric, start_date=None, end_date=None):
+        '''Returns the YYYYMMDD dates of the rows view() returns for the same arguments.'''
+        first, days, states = self.info(metric)
+        start = 0 if start_date is None else max((to_day(start_date) - to_day(first)).days, 0)
+        end = days if end_date is None else min((to_day(end_date) - to_day(first)).days + 1, days)
+        return np.array([to_date(to_day(first) + datetime.timedelta(days=offset)) for offset in range(start, end)], dtype=np.int64)
+
+    def drop(self, metric):
+        '''Deletes a metric's values and metadata.'''
+        self.maps.pop(metric, None)
+        self.cur.execute('DELETE FROM TimeSeries WHERE metric = ?', (metric,))
+        self.conn.commit()
+        if os.path.exists(self.path(metric)):
+            os.remove(self.path(metric))
+
+    def load_cases(self, metric='positive', since=None):
+        '''Takes in the name to store the cases under and optionally a YYYYMMDD date. Copies CovidData into
+        the store with load(). Returns the number of days stored.'''
+        return self.load(metric, CASES_QUERY, (), since)
+
+    def load_metric(self, metric, since=None):
+        '''Takes in the name of a metric in MetricTypes and optionally a YYYYMMDD date. Copies its
+        CovidMetrics values into the store with load(). Returns the number of days stored.'''
+        return self.load(metric, METRIC_QUERY, (metric,), since)
+
+    def load(self, metric, query, params, since=None):
+        '''Takes in the name to store values under, a query returning (YYYYMMDD date, state_id, value) rows
+        from the date given as its first parameter on, its other parameters and optionally a YYYYMMDD date.
+        The days from since on (by default from the last stored day, which the API may still revise) are
+        rewritten and newer days appended. The store is rebuilt from scratch if the number of states
+        changed. Returns the number of days stored.'''
+        self.cur.execute('SELECT MAX(state_id) FROM States')
+        states = self.cur.fetchone()[0]
+        info = self.info(metric)
+        if info is not None and info[2] != states:
+            self.drop(metric)
+            info = None
+        if since is None and info is not None:
+            since = to_date(to_day(info[0]) + datetime.timedelta(days=info[1] - 1)) if info[1] else info[0]
+        if info is not None and to_day(since) < to_day(info[0]):
+            self.drop(metric)
+            info = None
+
+        self.cur.execute(query, (since or 0,) + tuple(params))
+        rows = np.array(self.cur.fetchall(), dtype=np.int64).reshape(-1, 3)
+        if len(rows) == 0:
+            return 0 if info is None else info[1]
+
+        first = int(rows[:, 0].min()) if info is None else since
+        first_day = to_day(first)
+        dates, inverse = np.unique(rows[:, 0], return_inverse=True)
+        offsets = np.array([(to_day(date) - first_day).days for date in dates])[inverse]
+        values = np.full((offsets.max() + 1, states), MISSING, dtype=DTYPE)
+        values[offsets, rows[:, 1] - 1] = rows[:, 2]
+        return self.write(metric, first, values)
+
+    def close(self):
+        '''Drops the memory maps. Views handed out before keep theirs open.'''
+        self.maps = {}
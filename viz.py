@@ -1,32 +1,36 @@
-import requests
-import sqlite3
-import json
 import os
-from bs4 import BeautifulSoup
-import matplotlib.pyplot as plt
-import csv
-
-def setUpDatabase(db_name):
-    '''This function takes in the name of the database, makes a connection to server
-    using name given, and returns cur and conn as the cursor and connection variable
-    to allow database access.'''
-    
-    path = os.path.dirname(os.path.abspath(__file__))
-    conn = sqlite3.connect(path+'/'+db_name)
-    cur = conn.cursor()
-    return cur, conn
-
-def cases_percent_change(cur, conn):
-    '''This function takes in the cursor and connection variables. It uses matplotlib to create a bar graph
-    of the 10 states with highest % increase in COVID cases from Dec 2020 to Mar 2021 by using the PercentChange table.
-    Output is the creation of the graph.'''
-    percent_list = []
-    cur.execute('SELECT States.state, PercentChange.percent_change FROM PercentChange JOIN States ON PercentChange.state_id = States.state_id')
-    for row in cur:
-        percent_list.append(row)
-    percent_list = sorted(percent_list, key = lambda x: x[1], reverse=True)
-
-    top_ten = percent_list[:10]
+import inspect
+import functools
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from database import setUpDatabase
+import queries
+import derived_metrics
+import instrument
+import render_cache
+
+def get_axes(fig):
+    '''Takes in the Figure a chart should be drawn on, or None to draw in a new pyplot window.
+    Returns the figure and a fresh set of axes on it.'''
+    if fig is None:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    return fig, fig.subplots()
+
+def finish(fig, headless):
+    '''Shows the pyplot window of an interactive chart. Headless figures are left to the caller to save.'''
+    if not headless:
+        import matplotlib.pyplot as plt
+        plt.show()
+    return fig
+
+def cases_percent_change(cur, conn, fig=None):
+    '''This function takes in the cursor and connection variables, and optionally a matplotlib Figure to draw on.
+    It uses matplotlib to create a bar graph of the 10 states with highest % increase in COVID cases from Dec 2020
+    to Mar 2021 by reading the precomputed percent changes in DerivedMetrics. Without a figure the graph is shown in a window.
+    Returns the figure.'''
+    top_ten = queries.top_metric(cur, 'percent_change', derived_metrics.window(20201201, 20210307), 10)
 
     x = []
     y = []
@@ -37,106 +41,82 @@ def cases_percent_change(cur, conn):
 
     x_pos = [i for i, _ in enumerate(x)]
 
-    plt.bar(x_pos, y, color='green')
-    plt.xlabel('State')
-    plt.ylabel('Percent Change (%)')
-    plt.title('Highest percent changes in COVID cases from Dec 2020 to Mar 2021')
+    headless = fig is not None
+    fig, ax = get_axes(fig)
+    ax.bar(x_pos, y, color='green')
+    ax.set_xlabel('State')
+    ax.set_ylabel('Percent Change (%)')
+    ax.set_title('Highest percent changes in COVID cases from Dec 2020 to Mar 2021')
 
-    plt.xticks(x_pos, x)
+    ax.set_xticks(x_pos, x)
 
-    plt.show()
+    return finish(fig, headless)
 
-def highest_positives_viz(cur, conn):
-    '''This function takes in the cursor and connection variables. It uses matplotlib to create a bar graph
-    of the 10 states with highest # of COVID cases on Dec 1 2020 by using the CovidData table.
-    Output is the creation of the graph.'''
-    positives_list = []
-    cur.execute('SELECT States.state, Dates.date, CovidData.number_of_cases FROM CovidData JOIN States JOIN Dates ON CovidData.state_id = States.state_id and CovidData.date_id = Dates.date_id')
-    for row in cur:
-        if row[1] == '20201201':
-            positives_list.append(row)
-    positives_list = sorted(positives_list, key = lambda x: x[2], reverse=True)
-
-    top_ten = positives_list[:10]
+def highest_positives_viz(cur, conn, fig=None):
+    '''This function takes in the cursor and connection variables, and optionally a matplotlib Figure to draw on.
+    It uses matplotlib to create a bar graph of the 10 states with highest # of COVID cases on Dec 1 2020 by using
+    the CovidData table. Without a figure the graph is shown in a window. Returns the figure.'''
+    top_ten = queries.top_cases(cur, 20201201, 10)
 
     x = []
     y = []
 
     for item in top_ten:
         x.append(item[0])
-        y.append(item[2])
+        y.append(item[1])
 
     x_pos = [i for i, _ in enumerate(x)]
 
-    plt.bar(x_pos, y, color='blue')
-    plt.xlabel('State')
-    plt.ylabel('Positive Cases on Dec 1, 2020 (millions)')
-    plt.title('Highest positive cases by state in Dec 2020')
+    headless = fig is not None
+    fig, ax = get_axes(fig)
+    ax.bar(x_pos, y, color='blue')
+    ax.set_xlabel('State')
+    ax.set_ylabel('Positive Cases on Dec 1, 2020 (millions)')
+    ax.set_title('Highest positive cases by state in Dec 2020')
 
-    plt.xticks(x_pos, x)
+    ax.set_xticks(x_pos, x)
 
-    plt.show()
+    return finish(fig, headless)
 
-def pop_chart(cur, conn):
-    """This function takes in the cursor and connection variables. It uses matplotlib to create a pie chart of the 50 United States and their 2020 population numbers to create the division of the 2020 total US Population per state population. Output is the creation of the pie chart."""
+def pop_chart(cur, conn, fig=None):
+    """This function takes in the cursor and connection variables, and optionally a matplotlib Figure to draw on. It uses matplotlib to create a pie chart of the United States (states, DC and territories) and their 2020 population numbers to create the division of the 2020 total US Population per state population. Without a figure the chart is shown in a window. Returns the figure."""
     
     # Pie chart, where the slices will be ordered and plotted counter-clockwise:
 
     label = []
     population = []
 
-    # Grabbing Populations and States from the Database
-    cursor = cur.execute("SELECT state, population FROM Population")
-    for row in cursor:
-        if row[0].split(":")[1] == "2020":
-            label.append(row[0].split(":")[0])
-            num = row[1]
-            num = int(num.replace(',', ''))
-            population.append(num)
+    # Grabbing 2020 Populations and States from the Database, biggest first
+    for state, name, pop in queries.population_by_year(cur, 2020):
+        label.append(name)
+        population.append(pop)
 
     clearLabels = label[:8]
     for x in label[8:]:
         clearLabels.append("")
 
-    fig1, ax1 = plt.subplots()
+    headless = fig is not None
+    fig, ax1 = get_axes(fig)
     ax1.pie(population, labels=clearLabels, startangle=90)
     ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-    plt.title("Total 2020 US Population by State")
-
-    plt.show()
-
-def comparison_chart(cur, conn):
-    '''This function takes in the cursor and connection variables. It uses matplotlib to create a bar graph
-    of the 10 states with highest # of COVID cases on Dec 1 2020, exhibited as a percentage of their overall population.
-    Output is the creation of the graph.'''
-    states_list = ['ca', 'tx', 'fl', 'ny', 'il', 'ga', 'oh', 'wi', 'mi', 'tn']
-    pop_use_list = ['California:2020', 'Texas:2020', 'Florida:2020', 'New York:2020', 'Illinois:2020', 'Georgia:2020', 'Ohio:2020', 'Wisconsin:2020', 'Michigan:2020', 'Tennessee:2020']
-    cases_list = []
-    pop_list = []
+    ax1.set_title("Total 2020 US Population by State")
+
+    return finish(fig, headless)
+
+def comparison_chart(cur, conn, fig=None):
+    '''This function takes in the cursor and connection variables and optionally a matplotlib Figure to draw on.
+    It uses matplotlib to create a bar graph of the 10 states with highest # of COVID cases on Dec 1 2020, exhibited
+    as a percentage of their overall population, read from the precomputed cases per capita in DerivedMetrics.
+    Without a figure the graph is shown in a window. Returns the figure.'''
     percent_list = []
-    
-    cur.execute('SELECT States.state, Dates.date, CovidData.number_of_cases FROM CovidData JOIN States JOIN Dates ON CovidData.state_id = States.state_id and CovidData.date_id = Dates.date_id')
-    for row in cur:
-        for state in states_list:
-            if row[1] == '20201201' and row[0] == state:
-                cases_list.append(row)
-    cases_list = sorted(cases_list, key = lambda x: x[0])
-
-    cur.execute('SELECT Population.state, Population.population FROM Population')
-    for row in cur:
-        for state in pop_use_list:
-            if row[0] == state:
-                pop_list.append(row)
-    pop_list = sorted(pop_list, key = lambda x: x[0])
-
-    for i in range(10):
-        cases = cases_list[i][2]
-        pop = pop_list[i][1]
-        value = cases / int(pop.replace(',' , ''))
-        tup = (cases_list[i][0], value, cases)
+
+    per_capita = {state: value for state, name, value in queries.metric_values(cur, 'cases_per_capita', derived_metrics.window(20201201, 2020))}
+    # the 10 states with the most cases on the start date, highest first; no bar (NaN) for a state whose
+    # cases per capita can't be computed, e.g. without a 2020 population
+    for state, cases in queries.top_cases(cur, 20201201, 10):
+        value = per_capita.get(state)
+        tup = (state, float('nan') if value is None else value, cases)
         percent_list.append(tup)
-    
-    percent_list = sorted(percent_list, key = lambda x: x[2], reverse = True)
 
     x = []
     y = []
@@ -147,22 +127,160 @@ def comparison_chart(cur, conn):
 
     x_pos = [i for i, _ in enumerate(x)]
 
-    plt.bar(x_pos, y, color='black')
-    plt.xlabel('State')
-    plt.ylabel('Percent of population testing positive on Dec 1, 2020')
-    plt.title('States with highest number of Covid cases, shown as percentage of population')
-
-    plt.xticks(x_pos, x)
-
-    plt.show()
+    headless = fig is not None
+    fig, ax = get_axes(fig)
+    ax.bar(x_pos, y, color='black')
+    ax.set_xlabel('State')
+    ax.set_ylabel('Percent of population testing positive on Dec 1, 2020')
+    ax.set_title('States with highest number of Covid cases, shown as percentage of population')
+
+    ax.set_xticks(x_pos, x)
+
+    return finish(fig, headless)
+
+CHARTS = {
+    'cases_percent_change': cases_percent_change,
+    'highest_positives': highest_positives_viz,
+    'pop_chart': pop_chart,
+    'comparison_chart': comparison_chart,
+}
+
+FIGSIZE = (10, 6)
+
+@functools.lru_cache(maxsize=None)
+def chart_key(name, fmt):
+    '''Takes in the name of a chart in CHARTS and a file format. Returns the render_cache key of the file:
+    a hash of everything besides the data that decides how it looks (the chart's code, the size, the format
+    and the matplotlib version).'''
+    from importlib.metadata import version
+    return render_cache.key({'chart': name, 'format': fmt, 'figsize': FIGSIZE, 'matplotlib': version('matplotlib'),
+                             'code': inspect.getsource(CHARTS[name]) + inspect.getsource(render_chart)})
+
+def render_chart(name, out_dir, formats, db_name="finalProject.db"):
+    '''Takes in the name of a chart in CHARTS, the output directory, a list of file formats (png, svg...)
+    and the database name. Opens its own connection, draws the chart on an off-screen Figure with the Agg
+    backend and saves one file per format. The figure is cleared and the connection closed before
+    returning, so a long lived worker doesn't grow. Returns the list of files written, the queries the
+    chart read and the render_cache fingerprint of their results.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    cur, conn = setUpDatabase(db_name)
+    fig = Figure(figsize=FIGSIZE)
+    try:
+        with instrument.stage(f"render:{name}"):
+            with queries.recording() as results:
+                CHARTS[name](cur, conn, fig=fig)
+            paths = []
+            for fmt in formats:
+                path = os.path.join(out_dir, f"{name}.{fmt}")
+                fig.savefig(path, format=fmt, bbox_inches='tight')
+                paths.append(path)
+            #hashes exactly what was drawn, even if the database changed since
+            calls = [(query, params) for query, params, result in results]
+            digest = render_cache.digest(results)
+    finally:
+        fig.clear()
+        conn.close()
+    instrument.count('charts_rendered')
+    return paths, calls, digest
+
+def render_worker(name, out_dir, formats, db_name, profile_dir):
+    '''Runs render_chart in a worker process with its own instrument run (profiled into profile_dir if
+    given). Returns what render_chart returns followed by the worker's instrument snapshot.'''
+    instrument.reset(profile_dir)
+    paths, calls, digest = render_chart(name, out_dir, formats, db_name)
+    return paths, calls, digest, instrument.snapshot()
+
+def write_file(path, body):
+    '''Writes body to path unless the file already holds exactly that, so unchanged charts keep their
+    modification time.'''
+    if os.path.exists(path) and os.path.getsize(path) == len(body):
+        with open(path, 'rb') as f:
+            if f.read() == body:
+                return
+    with open(path, 'wb') as f:
+        f.write(body)
+
+def render_all(out_dir, formats=('png',), processes=None, db_name="finalProject.db", cache_file='render_cache.db', force=False):
+    '''Takes in the output directory, the file formats, the number of worker processes (None for one per CPU),
+    the database name, the render cache file (None to render without one) and whether to render every chart
+    even if it is cached. Renders every chart in CHARTS to files without opening any window, each chart in
+    its own process since they are independent. DerivedMetrics is refreshed first so the workers only read.
+    Charts whose code, parameters and query results are unchanged since they were cached are copied from the
+    cache instead of being drawn. The timings and counters of the workers are added to the current
+    instrument run. Returns the list of files written.'''
+    os.makedirs(out_dir, exist_ok=True)
+    cache = render_cache.RenderCache(cache_file) if cache_file is not None else None
+    cur, conn = setUpDatabase(db_name)
+    derived_metrics.refresh(cur, conn)
+    paths = []
+    stale = []
+    for name in CHARTS:
+        bodies = None if cache is None or force else cache.lookup(cur, [chart_key(name, fmt) for fmt in formats])
+        if bodies is None:
+            stale.append(name)
+            continue
+        for fmt, body in zip(formats, bodies):
+            path = os.path.join(out_dir, f"{name}.{fmt}")
+            write_file(path, body)
+            paths.append(path)
+        instrument.count('charts_cached')
+    conn.close()
+
+    profile_dir = instrument.profile_dir()
+    try:
+        #forked workers would inherit locks other threads of the pipeline hold (instrument, sqlite)
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            #imported once by the server instead of by every worker
+            context.set_forkserver_preload(['viz', 'matplotlib.figure'])
+        else:
+            context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            futures = {name: pool.submit(render_worker, name, out_dir, list(formats), db_name, profile_dir) for name in stale}
+            for name, future in futures.items():
+                chart_paths, calls, digest, run = future.result()
+                paths.extend(chart_paths)
+                instrument.merge(run)
+                if cache is not None:
+                    cache.store(name, [(chart_key(name, fmt), path) for fmt, path in zip(formats, chart_paths)], calls, digest)
+    finally:
+        if cache is not None:
+            cache.close()
+    return paths
+
+def main(headless=False, out_dir=None, formats=('png',), processes=None, report=None, profile_dir=None, force=False):
+    '''Establishes connection to server and creates visualizations. In headless mode every chart is rendered
+    to files in out_dir (a charts folder next to the script by default) instead of being shown, skipping the
+    charts whose data hasn't changed unless force is set, and if report is given the stage timings and
+    counters of the run are saved there as JSON.'''
+    instrument.reset(profile_dir)
+    if headless:
+        if out_dir is None:
+            out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'charts')
+        for path in render_all(out_dir, formats, processes, force=force):
+            print(path)
+        if report is not None:
+            instrument.write_report(report)
+        return
 
-def main():
-    '''Establishes connection to server and creates visualizations.'''
     cur, conn = setUpDatabase("finalProject.db")
+    derived_metrics.refresh(cur, conn)
     cases_percent_change(cur, conn)
     highest_positives_viz(cur, conn)
     pop_chart(cur, conn)
     comparison_chart(cur, conn)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Draw the COVID and population charts.')
+    parser.add_argument('--headless', action='store_true', help='render every chart to files instead of showing them')
+    parser.add_argument('--out', help='output directory for --headless (default: charts next to this script)')
+    parser.add_argument('--formats', default='png', help='comma separated file formats, e.g. png,svg')
+    parser.add_argument('--processes', type=int, help='worker processes for --headless (default: one per CPU)')
+    parser.add_argument('--report', metavar='PATH', help='with --headless, save stage timings and counters as JSON to PATH')
+    parser.add_argument('--profile', metavar='DIR', help='save a cProfile dump of every stage to DIR')
+    parser.add_argument('--force', action='store_true', help='with --headless, draw every chart again even if it is in the render cache')
+    args = parser.parse_args()
+    main(args.headless, args.out, args.formats.split(','), args.processes, args.report, args.profile, args.force)